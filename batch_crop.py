@@ -0,0 +1,162 @@
+"""auto_transparent_by_corner をフォルダ単位でまとめて実行する（Qt 不要）
+
+    python batch_crop.py photos/ "scans/**/*.jpg" -o out/ -t 30 -j 8 --skip-up-to-date
+    python batch_crop.py photos/ --format webp --optimize
+    python batch_crop.py photos/ --key-range 150,150,150-200,200,200   # 影も透過する
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from corner_crop import OUTPUT_SUFFIX, OutputOptions, auto_transparent_by_corner, output_path_for
+import config
+import argparse
+import glob
+import os
+import sys
+import time
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+def _glob_root(pattern):
+    # The directories before the first wildcard; matches are placed relative to it
+    parts = []
+    for part in os.path.normpath(pattern).split(os.sep)[:-1]:
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return os.sep.join(parts) if parts != [""] else os.sep
+
+
+def collect_images(inputs, recursive=False):
+    """ディレクトリ・glob・ファイルパスから処理対象の画像を集める（出力済みファイルは除く）
+
+    (画像のパス, 入力のルート) のリストを返す。ルートはディレクトリならそれ自身、glob なら
+    ワイルドカードより前のディレクトリ、ファイルならそのディレクトリ。
+    """
+    images = {}
+    for item in inputs:
+        if os.path.isdir(item):
+            pattern = os.path.join(item, "**", "*") if recursive else os.path.join(item, "*")
+            candidates = glob.glob(pattern, recursive=recursive)
+            root = item
+        else:
+            candidates = glob.glob(item, recursive=True) or [item]
+            root = _glob_root(item)
+        for path in sorted(candidates):
+            if (os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS)
+                    and not path.endswith(OUTPUT_SUFFIX)):
+                images.setdefault(path, root)
+    return list(images.items())
+
+
+def output_dir_for(image_path, root, output_dir=None):
+    """-o の下に入力のルートからの相対的なフォルダ構成を保った出力先 (-o が無ければ None = 元画像の隣)"""
+    if not output_dir:
+        return None
+    relative = os.path.relpath(os.path.dirname(os.path.abspath(image_path)), os.path.abspath(root))
+    return os.path.normpath(os.path.join(output_dir, relative))
+
+
+def output_collisions(jobs, image_format="png"):
+    """同じ出力先になる (出力先, [画像のパス, ...]) のリスト (p0.jpg と p0.png など)"""
+    sources = {}
+    for image_path, output_dir in jobs:
+        output_path = os.path.abspath(output_path_for(image_path, output_dir, image_format))
+        sources.setdefault(os.path.normcase(output_path), []).append(image_path)
+    return [(output_path, paths) for output_path, paths in sources.items() if len(paths) > 1]
+
+
+def is_up_to_date(image_path, output_dir=None, image_format="png"):
+    output_path = output_path_for(image_path, output_dir, image_format)
+    return os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(image_path)
+
+
+def _key_range(text):
+    try:
+        lo, hi = (tuple(int(v) for v in part.split(",")) for part in text.split("-"))
+    except ValueError:
+        lo = hi = ()
+    if len(lo) != 3 or len(hi) != 3 or not all(0 <= v <= 255 for v in lo + hi):
+        raise argparse.ArgumentTypeError("R,G,B-R,G,B の形式で 0〜255 の値を指定してください")
+    return tuple(map(min, lo, hi)), tuple(map(max, lo, hi))
+
+
+def _process(image_path, tolerance, output_dir, streaming, border_only, options, key_ranges):
+    output_path = auto_transparent_by_corner(
+        image_path, tolerance, output_dir, verbose=False, streaming=streaming, border_only=border_only,
+        options=options, key_ranges=key_ranges)
+    return output_path, os.path.getsize(image_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="四隅の背景色を透過してクロップする一括処理")
+    parser.add_argument("inputs", nargs="+", help="画像ファイル・ディレクトリ・glob パターン")
+    parser.add_argument("-t", "--tolerance", type=int, default=30, help="透過範囲 (既定: 30)")
+    parser.add_argument("-o", "--output-dir",
+                        help="出力先ディレクトリ。入力フォルダからのサブフォルダ構成を保つ (既定: 元画像と同じ場所)")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="ワーカープロセス数")
+    parser.add_argument("-r", "--recursive", action="store_true", help="ディレクトリを再帰的に探す")
+    parser.add_argument("--skip-up-to-date", action="store_true", help="出力が元画像より新しければ飛ばす")
+    parser.add_argument("--streaming", action="store_true", default=None,
+                        help="全画像を帯ごとに処理する (既定: 巨大な画像のみ)")
+    parser.add_argument("--border-only", action="store_true",
+                        help="画像の外周からつながる背景だけを透過する (錠剤の中の白い部分を残す)")
+    parser.add_argument("--format", choices=["png", "webp"], default=config.OUTPUT_FORMAT,
+                        help=f"保存形式 (どちらも可逆、既定: {config.OUTPUT_FORMAT})")
+    parser.add_argument("--compress-level", type=int, choices=range(10), default=config.OUTPUT_COMPRESS_LEVEL,
+                        metavar="0-9", help=f"PNG の圧縮レベル (既定: {config.OUTPUT_COMPRESS_LEVEL})")
+    parser.add_argument("--optimize", action="store_true", default=bool(config.OUTPUT_OPTIMIZE),
+                        help="時間をかけてより小さく圧縮する")
+    parser.add_argument("--key-range", type=_key_range, action="append", default=[], metavar="R,G,B-R,G,B",
+                        help="四隅の背景色に加えて透過する色の範囲 (複数指定可)")
+    args = parser.parse_args(argv)
+    options = OutputOptions(args.format, args.compress_level, args.optimize)
+
+    jobs = [(path, output_dir_for(path, root, args.output_dir))
+            for path, root in collect_images(args.inputs, args.recursive)]
+    # Refuse before anything is written: a later job would silently replace
+    # an earlier output, and --skip-up-to-date would never notice
+    collisions = output_collisions(jobs, args.format)
+    if collisions:
+        for output_path, sources in collisions:
+            print(f"エラー: 出力先が重なります: {output_path} <- {', '.join(sources)}", file=sys.stderr)
+        return 1
+    for output_dir in {output_dir for _path, output_dir in jobs if output_dir}:
+        os.makedirs(output_dir, exist_ok=True)
+    if args.skip_up_to_date:
+        pending = [job for job in jobs if not is_up_to_date(job[0], job[1], args.format)]
+        print(f"最新のためスキップ: {len(jobs) - len(pending)} 件")
+        jobs = pending
+    if not jobs:
+        print("処理する画像がありません。")
+        return 0
+
+    total = len(jobs)
+    failed = 0
+    total_bytes = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(_process, path, args.tolerance, output_dir, args.streaming, args.border_only,
+                            options, tuple(args.key_range)): path
+            for path, output_dir in jobs
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            path = futures[future]
+            try:
+                output_path, size = future.result()
+                total_bytes += size
+                status = f"-> {output_path}"
+            except Exception as e:
+                failed += 1
+                status = f"エラー: {e}"
+            elapsed = time.perf_counter() - start
+            print(f"[{done}/{total}] {path} {status} ({done / elapsed:.1f} 枚/秒)", flush=True)
+
+    elapsed = time.perf_counter() - start
+    print(f"完了: {total - failed} 件成功, {failed} 件失敗, {elapsed:.1f} 秒 "
+          f"({total / elapsed:.1f} 枚/秒, {total_bytes / elapsed / 1024 / 1024:.1f} MB/秒)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,229 @@
+"""透過処理・クロップ・描画・DB 操作のベンチマーク（Qt は offscreen で動かす）
+
+    python benchmarks/run_benchmarks.py --sizes 1,12,24 --rows 1000,100000 -o before.json
+    python benchmarks/run_benchmarks.py --compare before.json -o after.json
+
+結果は JSON で出力する。--compare を付けると前回の結果との比率も表示する。
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image
+import PIL
+from PyQt6.QtCore import QT_VERSION_STR, QSize, Qt
+from PyQt6.QtGui import QImage, QPixmap
+from PyQt6.QtWidgets import QApplication
+
+from corner_crop import auto_transparent_by_corner
+from db import CatalogDB, SQL_INSERT_IMAGE
+from keying import apply_tolerance_argb32, distance_map
+from phash import PhashIndex
+from streaming import keyed_bbox
+
+DISPLAY_SIZE = QSize(800, 600)
+
+
+def synthetic_pill(megapixels, seed=0):
+    """白っぽい背景の中央に錠剤のような楕円がある RGB 画像 (4:3)"""
+    height = int((megapixels * 1e6 * 3 / 4) ** 0.5)
+    width = int(height * 4 / 3)
+    rng = np.random.default_rng(seed)
+    img = np.empty((height, width, 3), dtype=np.uint8)
+    img[:] = 245
+    img += rng.integers(0, 8, (height, width, 1), dtype=np.uint8)
+    y, x = np.ogrid[:height, :width]
+    pill = ((x - width / 2) / (width / 4)) ** 2 + ((y - height / 2) / (height / 5)) ** 2 <= 1
+    img[pill] = (200, 120, 60)
+    return img
+
+
+def measure(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+class Runner:
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = []
+
+    def run(self, name, params, fn, repeat=None):
+        times = measure(fn, repeat or self.repeat)
+        result = {
+            "name": name,
+            "params": params,
+            "repeat": len(times),
+            "min_s": min(times),
+            "median_s": statistics.median(times),
+            "mean_s": statistics.fmean(times),
+        }
+        self.results.append(result)
+        print(f"{name:<28} {json.dumps(params, ensure_ascii=False):<36} "
+              f"median {result['median_s'] * 1000:10.2f} ms", file=sys.stderr, flush=True)
+        return result
+
+
+def bench_images(runner, sizes, workdir):
+    for megapixels in sizes:
+        params = {"mp": megapixels}
+        rgb = synthetic_pill(megapixels)
+        jpeg_path = os.path.join(workdir, f"pill_{megapixels}mp.jpg")
+        png_path = os.path.join(workdir, f"pill_{megapixels}mp.png")
+        Image.fromarray(rgb).save(jpeg_path, quality=90)
+        Image.fromarray(rgb).save(png_path, compress_level=1)
+        del rgb
+
+        def decode(path):
+            with Image.open(path) as img:
+                return np.array(img.convert("RGBA"))
+
+        runner.run("decode_jpeg", params, lambda: decode(jpeg_path))
+        runner.run("decode_png", params, lambda: decode(png_path))
+
+        rgba = decode(jpeg_path)
+        rgba.flags.writeable = False
+        target = (245, 245, 245)
+        runner.run("distance_map", params, lambda: distance_map(rgba, target))
+        # Shadow and gradient boxes through the 256^3 table (built once, outside the timing)
+        key_ranges = (((200, 200, 200), (244, 244, 244)), ((150, 150, 160), (190, 190, 200)))
+        distance_map(rgba, target, key_ranges)
+        runner.run("distance_map_key_ranges", params, lambda: distance_map(rgba, target, key_ranges))
+        dist = distance_map(rgba, target)
+        runner.run("apply_tolerance", params, lambda: apply_tolerance_argb32(rgba, dist, 10, opaque=True))
+        runner.run("apply_tolerance_border", params,
+                   lambda: apply_tolerance_argb32(rgba, dist, 10, opaque=True, border_only=True))
+
+        runner.run("keyed_bbox_streaming", params,
+                   lambda: keyed_bbox(Image.fromarray(rgba), target, 10))
+        runner.run("corner_crop", params, lambda: auto_transparent_by_corner(
+            jpeg_path, 30, workdir, verbose=False, streaming=False))
+        runner.run("corner_crop_streaming", params, lambda: auto_transparent_by_corner(
+            jpeg_path, 30, workdir, verbose=False, streaming=True))
+
+        keyed = apply_tolerance_argb32(rgba, dist, 10, opaque=True)
+        height, width = keyed.shape[:2]
+        qimg = QImage(keyed.data, width, height, width * 4, QImage.Format.Format_ARGB32_Premultiplied)
+        runner.run("qimage_wrap", params, lambda: QImage(
+            keyed.data, width, height, width * 4, QImage.Format.Format_ARGB32_Premultiplied))
+        runner.run("qpixmap_from_image", params, lambda: QPixmap.fromImage(qimg))
+        pixmap = QPixmap.fromImage(qimg)
+        runner.run("scale_smooth", params, lambda: pixmap.scaled(
+            DISPLAY_SIZE, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation))
+        runner.run("scale_fast", params, lambda: pixmap.scaled(
+            DISPLAY_SIZE, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.FastTransformation))
+        del rgba, dist, keyed, qimg, pixmap
+        for path in (jpeg_path, png_path):
+            os.remove(path)
+
+
+def bench_db(runner, row_counts, workdir, drugs_per_catalog=1000):
+    for rows in row_counts:
+        params = {"rows": rows}
+        db_path = os.path.join(workdir, f"catalog_{rows}.db")
+        db = CatalogDB(db_path)
+        phashes = np.random.default_rng(0).integers(-2**63, 2**63 - 1, rows, dtype=np.int64, endpoint=True)
+        catalog = [
+            (f"drug{i % drugs_per_catalog:05d}", f"/images/{i:07d}.jpg", 255, 255, 255, 10, 0, int(phashes[i]), None)
+            for i in range(rows)
+        ]
+
+        def bulk_insert():
+            with db.transaction():
+                db.conn.execute("DELETE FROM images")
+                db.conn.executemany(SQL_INSERT_IMAGE, catalog)
+
+        runner.run("db_bulk_insert", params, bulk_insert, repeat=1)
+        runner.run("db_insert_commit_each", params,
+                   lambda: [db.add_image("bench", "/images/x.jpg", (255, 255, 255), 10) for _ in range(100)],
+                   repeat=1)
+        runner.run("db_drug_names", params, db.drug_names)
+        db.rebuild_drug_index()
+        runner.run("db_search_drugs_first_page", params, lambda: db.search_drugs("drug0004", 200))
+        runner.run("db_search_drugs_romaji", params, lambda: db.search_drugs("asupi", 200))
+        runner.run("db_images_for_drug", params, lambda: db.images_for_drug("drug00042"))
+        runner.run("phash_load_index", params, lambda: PhashIndex.from_db(db))
+        index = PhashIndex.from_db(db)
+        runner.run("phash_nearest", params, lambda: index.nearest(int(phashes[0]), k=20))
+        db.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {
+            (r["name"], json.dumps(r["params"], sort_keys=True)): r for r in json.load(f)["results"]
+        }
+    print(f"\n{'benchmark':<28} {'params':<20} {'before ms':>10} {'after ms':>10} {'ratio':>7}", file=sys.stderr)
+    for result in results:
+        before = baseline.get((result["name"], json.dumps(result["params"], sort_keys=True)))
+        if before is None:
+            continue
+        ratio = result["median_s"] / before["median_s"] if before["median_s"] else float("inf")
+        print(f"{result['name']:<28} {json.dumps(result['params']):<20} "
+              f"{before['median_s'] * 1000:10.2f} {result['median_s'] * 1000:10.2f} {ratio:7.2f}",
+              file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="seathr のベンチマーク")
+    parser.add_argument("--sizes", default="1,5,12,24,50", help="画像サイズ (MP, カンマ区切り)")
+    parser.add_argument("--rows", default="1000,10000,100000,1000000", help="DB の行数 (カンマ区切り)")
+    parser.add_argument("--repeat", type=int, default=5, help="各ベンチマークの繰り返し回数")
+    parser.add_argument("--skip-images", action="store_true")
+    parser.add_argument("--skip-db", action="store_true")
+    parser.add_argument("-o", "--output", help="結果の JSON を書き出すファイル (既定: 標準出力)")
+    parser.add_argument("--compare", help="比較する以前の結果の JSON")
+    args = parser.parse_args(argv)
+
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    runner = Runner(args.repeat)
+    with tempfile.TemporaryDirectory(prefix="seathr_bench_") as workdir:
+        if not args.skip_images:
+            bench_images(runner, [float(s) for s in args.sizes.split(",") if s], workdir)
+        if not args.skip_db:
+            bench_db(runner, [int(s) for s in args.rows.split(",") if s], workdir)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "pillow": PIL.__version__,
+            "qt": QT_VERSION_STR,
+            "qt_platform": app.platformName(),
+            "repeat": args.repeat,
+        },
+        "results": runner.results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        compare(runner.results, args.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
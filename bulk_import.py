@@ -0,0 +1,176 @@
+"""フォルダ単位で画像を drugs.db に一括登録する（Qt 不要）
+
+    python bulk_import.py photos/ --db drugs.db -j 8
+
+photos/ の直下のフォルダ名を薬剤名とし、その中（サブフォルダも含む）の画像を登録する。
+背景色は auto_transparent_by_corner と同じく四隅の平均色を使う。
+類似画像の検索 (find_similar.py) 用の知覚ハッシュも一緒に計算して登録する。
+内容 (SHA-1) が登録済みの画像と同じものは飛ばす。
+"""
+from concurrent.futures import ProcessPoolExecutor
+from batch_crop import IMAGE_EXTENSIONS
+from corner_crop import OUTPUT_SUFFIX
+from db import CatalogDB
+from functools import partial
+from phash import corner_phash, to_db
+import argparse
+import hashlib
+import io
+import os
+import sys
+import time
+
+BATCH_SIZE = 1000
+
+
+def collect_drug_images(root, parent_folder=False):
+    """root 以下の (薬剤名, 画像の絶対パス) のリスト。薬剤名は root 直下のフォルダ名
+    (parent_folder=True なら画像のすぐ上のフォルダ名)。root 直下の画像は対象外"""
+    root = os.path.abspath(root)
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        if dirpath == root:
+            continue
+        relative = os.path.relpath(dirpath, root)
+        drug_name = os.path.basename(dirpath) if parent_folder else relative.split(os.sep)[0]
+        for filename in sorted(filenames):
+            if filename.lower().endswith(IMAGE_EXTENSIONS) and not filename.endswith(OUTPUT_SUFFIX):
+                entries.append((drug_name, os.path.join(dirpath, filename)))
+    return entries
+
+
+def _stat(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def _hash(path):
+    """(パス, 更新時刻, サイズ, SHA-1)。読めなければ None"""
+    try:
+        mtime_ns, size = _stat(path)
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return path, mtime_ns, size, digest.hexdigest()
+
+
+def _analyze(path, tolerance, border_only):
+    """(パス, 更新時刻, サイズ, SHA-1, 背景色, 知覚ハッシュ)。読めなければ背景色の代わりに例外の文字列"""
+    try:
+        mtime_ns, size = _stat(path)
+        with open(path, "rb") as f:
+            data = f.read()
+        sha1 = hashlib.sha1(data).hexdigest()
+    except OSError as e:
+        return path, None, None, None, str(e), None
+    try:
+        # 四隅の色も知覚ハッシュ用に縮小デコードした画像から求める
+        color, phash = corner_phash(io.BytesIO(data), tolerance, border_only)
+        return path, mtime_ns, size, sha1, color, to_db(phash)
+    except Exception as e:
+        return path, mtime_ns, size, sha1, str(e), None
+
+
+def known_hashes(db, executor, chunksize):
+    """登録済みの画像の SHA-1 の集合と、パスごとの (更新時刻, サイズ, SHA-1)。
+    記録が無いか古い画像はここでハッシュを取り直して source_hashes に記録する"""
+    cached = db.source_hashes()
+    hashes = set()
+    stale = []
+    for path in db.image_paths():
+        try:
+            stat = _stat(path)
+        except OSError:
+            continue
+        entry = cached.get(path)
+        if entry and entry[:2] == stat:
+            hashes.add(entry[2])
+        else:
+            stale.append(path)
+    fresh = [row for row in executor.map(_hash, stale, chunksize=chunksize) if row]
+    db.put_source_hashes(fresh)
+    for path, mtime_ns, size, sha1 in fresh:
+        hashes.add(sha1)
+        cached[path] = (mtime_ns, size, sha1)
+    return hashes, cached
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="フォルダごとの画像を薬剤として drugs.db に一括登録する")
+    parser.add_argument("root", help="薬剤ごとのフォルダが並ぶディレクトリ")
+    parser.add_argument("--db", default="drugs.db", help="データベースファイル (既定: drugs.db)")
+    parser.add_argument("-t", "--tolerance", type=int, default=30, help="登録する透過範囲 (既定: 30)")
+    parser.add_argument("--border-only", action="store_true", help="外周につながる背景だけを透過する設定で登録する")
+    parser.add_argument("--parent-folder", action="store_true",
+                        help="画像のすぐ上のフォルダ名を薬剤名にする (既定: root 直下のフォルダ名)")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="ワーカープロセス数")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="1 トランザクションで登録する件数")
+    args = parser.parse_args(argv)
+
+    entries = collect_drug_images(args.root, args.parent_folder)
+    if not entries:
+        print("登録する画像がありません。")
+        return 0
+
+    start = time.perf_counter()
+    db = CatalogDB(args.db)
+    added = duplicates = failed = 0
+    pending_rows = []
+    pending_hashes = []
+
+    def flush():
+        db.add_images(pending_rows)
+        db.put_source_hashes(pending_hashes)
+        pending_rows.clear()
+        pending_hashes.clear()
+
+    chunksize = 32
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        seen, cached = known_hashes(db, executor, chunksize)
+        # 前回の取り込みでハッシュを記録済みのファイルは読まずに重複と判定できる
+        to_analyze = []
+        drug_of = {}
+        for drug_name, path in entries:
+            entry = cached.get(path)
+            try:
+                if entry and entry[2] in seen and entry[:2] == _stat(path):
+                    duplicates += 1
+                    continue
+            except OSError:
+                pass
+            to_analyze.append(path)
+            drug_of[path] = drug_name
+
+        total = len(to_analyze)
+        analyze = partial(_analyze, tolerance=args.tolerance, border_only=args.border_only)
+        for done, (path, mtime_ns, size, sha1, color, phash) in enumerate(
+                executor.map(analyze, to_analyze, chunksize=chunksize), 1):
+            if isinstance(color, str):
+                failed += 1
+                print(f"エラー: {path}: {color}", file=sys.stderr)
+            elif sha1 in seen:
+                duplicates += 1
+            else:
+                seen.add(sha1)
+                pending_rows.append((drug_of[path], path, color, args.tolerance, args.border_only, phash, ()))
+                pending_hashes.append((path, mtime_ns, size, sha1))
+                added += 1
+                if len(pending_rows) >= args.batch_size:
+                    flush()
+            if done % 500 == 0 or done == total:
+                elapsed = time.perf_counter() - start
+                print(f"[{done}/{total}] 登録 {added} 件, 重複 {duplicates} 件 ({done / elapsed:.1f} 枚/秒)", flush=True)
+    flush()
+    db.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"完了: {added} 件登録, {duplicates} 件重複のためスキップ, {failed} 件失敗, {elapsed:.1f} 秒")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
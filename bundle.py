@@ -0,0 +1,328 @@
+"""薬剤 1 つ分の透過済み画像とそのパラメータをまとめた 1 ファイルのバンドル (.drugbundle)
+
+ネットワーク共有上で画像ごとにファイルを開く代わりに、バンドルを 1 回開いて mmap し、
+索引に書かれた位置から画素を直接読む。
+
+    ヘッダ (HEADER_SIZE バイト): MAGIC, バージョン, 索引の位置と長さ
+    画素: 画像ごとに ALIGN バイト境界から、QImage.Format_ARGB32_Premultiplied の並び
+          (zlib で軽く圧縮、または無圧縮)。不透明な範囲だけに切り抜き、既定では
+          表示に足りる大きさまで縮小してある
+    索引: 薬剤名と、画像ごとのパラメータ・大きさ・切り抜いた位置・縮小率・ファイル内の位置の JSON
+"""
+import hashlib
+import io
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from image_cache import proxy_factor, reduce_on_decode
+from keying import ARGB32_ORDER, apply_tolerance_argb32, distance_map
+
+EXTENSION = ".drugbundle"
+MAGIC = b"SEATHRB\0"
+VERSION = 1
+HEADER = struct.Struct("<8sIQQ")  # magic, version, index offset, index length
+HEADER_SIZE = 64
+ALIGN = 64
+# 軽い圧縮 (展開が速いことを優先する)
+ZLIB_LEVEL = 1
+# 既定では MAX_SIZE×MAX_SIZE の表示に足りる範囲で縮小して書き出す (ビューアの縮小プレビューと同じ)
+MAX_SIZE = 1024
+
+# UNPREMULTIPLY_LUT[a, c] = min(255, round(c * 255 / a))
+UNPREMULTIPLY_LUT = np.minimum(
+    (np.arange(256, dtype=np.uint32)[None, :] * 255 + np.arange(256, dtype=np.uint32)[:, None] // 2)
+    // np.maximum(np.arange(256, dtype=np.uint32)[:, None], 1), 255).astype(np.uint8)
+
+
+def keyed_argb32(path, target_rgb, tolerance, border_only=False, key_ranges=(), max_size=None):
+    """画像ファイルをビューアと同じように透過処理した Format_ARGB32_Premultiplied の配列 (H×W×4) と縮小率
+
+    max_size を渡すと、max_size×max_size の表示に足りる範囲で 1/2, 1/4, ... に縮小してから処理する。
+    """
+    with Image.open(path) as img:
+        factor = proxy_factor(img.size, (max_size, max_size)) if max_size else 1
+        reduced = reduce_on_decode(img, factor) if factor > 1 else img
+        opaque = not reduced.has_transparency_data
+        rgba = np.array(reduced.convert("RGBA"))
+    dist = distance_map(rgba, target_rgb, key_ranges)
+    return apply_tolerance_argb32(rgba, dist, tolerance, opaque, border_only), factor
+
+
+def alpha_bbox(argb):
+    """Format_ARGB32_Premultiplied の配列の不透明な範囲 (x, y, 幅, 高さ)。すべて透明なら全体"""
+    alpha = argb[..., ARGB32_ORDER.index(3)]
+    rows = np.flatnonzero(alpha.any(axis=1))
+    cols = np.flatnonzero(alpha.any(axis=0))
+    if not rows.size:
+        return 0, 0, argb.shape[1], argb.shape[0]
+    return int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1)
+
+
+def argb32_to_rgba(argb):
+    """Format_ARGB32_Premultiplied の配列を乗算なしの RGBA 配列にする"""
+    rgba = argb[..., np.argsort(ARGB32_ORDER)]
+    alpha = rgba[..., 3]
+    partial = (alpha != 0) & (alpha != 255)
+    if partial.any():
+        for channel in range(3):
+            rgba[..., channel][partial] = UNPREMULTIPLY_LUT[alpha[partial], rgba[..., channel][partial]]
+    return rgba
+
+
+class BundleWriter:
+    """バンドルを一時ファイルに書き、close() で索引を書いて置き換える"""
+
+    def __init__(self, path, drug_name, compress=True):
+        self.path = path
+        self.drug_name = drug_name
+        self.compress = compress
+        self.entries = []
+        self.tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        self.file = open(self.tmp_path, "wb")
+        self.file.write(bytes(HEADER_SIZE))
+
+    def add(self, argb, source_path, target_rgb, tolerance, border_only=False, key_ranges=(), factor=1):
+        """透過済みの配列を不透明な範囲に切り抜いて書き込む。factor は argb の縮小率"""
+        frame_height, frame_width = argb.shape[:2]
+        x, y, width, height = alpha_bbox(argb)
+        data = np.ascontiguousarray(argb[y:y + height, x:x + width]).reshape(-1).data
+        if self.compress:
+            data = zlib.compress(data, ZLIB_LEVEL)
+        offset = -(-self.file.tell() // ALIGN) * ALIGN
+        self.file.write(bytes(offset - self.file.tell()))
+        self.file.write(data)
+        self.entries.append({
+            "source_path": source_path, "target_rgb": list(target_rgb), "tolerance": tolerance,
+            "border_only": bool(border_only), "key_ranges": [[list(lo), list(hi)] for lo, hi in key_ranges],
+            "width": width, "height": height, "x": x, "y": y, "frame_width": frame_width,
+            "frame_height": frame_height, "factor": factor, "offset": offset, "length": len(data),
+            "compression": "zlib" if self.compress else "none",
+        })
+
+    def close(self):
+        index = json.dumps({"drug_name": self.drug_name, "byte_order": sys.byteorder, "images": self.entries},
+                           ensure_ascii=False).encode("utf-8")
+        index_offset = self.file.tell()
+        self.file.write(index)
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, VERSION, index_offset, len(index)))
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class DrugBundle:
+    """バンドルを mmap して開く。画像の読み出しでファイルを開き直すことはない
+
+    entries は images_for_drug と同じ形の (None, drug_name, source_path, (r, g, b), tolerance,
+    border_only, key_ranges) のリスト (ID の代わりに None)。形式が違えば ValueError。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._read_index()
+        except (json.JSONDecodeError, UnicodeDecodeError, KeyError, IndexError, TypeError, struct.error) as e:
+            # A truncated or hand-edited index; report it like any other bad file
+            self.mm.close()
+            raise ValueError(f"バンドルの索引が壊れています ({e}): {self.path}") from e
+        except ValueError:
+            self.mm.close()
+            raise
+
+    def _read_index(self):
+        if len(self.mm) < HEADER_SIZE:
+            raise ValueError(f"バンドルではありません: {self.path}")
+        magic, version, index_offset, index_length = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            raise ValueError(f"バンドルではありません: {self.path}")
+        if version != VERSION:
+            raise ValueError(f"未対応のバンドルのバージョンです ({version}): {self.path}")
+        if index_offset + index_length > len(self.mm):
+            raise ValueError(f"バンドルが途中で切れています: {self.path}")
+        index = json.loads(self.mm[index_offset:index_offset + index_length].decode("utf-8"))
+        self.drug_name = index["drug_name"]
+        self.swap_bytes = index["byte_order"] != sys.byteorder
+        self.images = index["images"]
+        for image in self.images:
+            # argb32() trusts these, so check them once here
+            if image["offset"] < HEADER_SIZE or image["offset"] + image["length"] > index_offset:
+                raise ValueError(f"バンドルの索引が壊れています: {self.path}")
+            if image["compression"] == "none" and image["length"] != image["width"] * image["height"] * 4:
+                raise ValueError(f"バンドルの索引が壊れています: {self.path}")
+            image.setdefault("x", 0)
+            image.setdefault("y", 0)
+            image.setdefault("frame_width", image["width"])
+            image.setdefault("frame_height", image["height"])
+            image.setdefault("factor", 1)
+            if (image["x"] < 0 or image["y"] < 0 or image["x"] + image["width"] > image["frame_width"]
+                    or image["y"] + image["height"] > image["frame_height"]):
+                raise ValueError(f"バンドルの索引が壊れています: {self.path}")
+        self.entries = [
+            (None, self.drug_name, image["source_path"], tuple(image["target_rgb"]), image["tolerance"],
+             image["border_only"], tuple((tuple(lo), tuple(hi)) for lo, hi in image["key_ranges"]))
+            for image in self.images
+        ]
+
+    def __len__(self):
+        return len(self.images)
+
+    def argb32(self, i):
+        """i 番目の画像の Format_ARGB32_Premultiplied の配列 (H×W×4, 読み取り専用)
+
+        無圧縮で同じバイト順なら mmap をそのまま参照する (コピーしない)。圧縮された画素が壊れていれば ValueError。
+        """
+        image = self.images[i]
+        shape = (image["height"], image["width"], 4)
+        if image["compression"] == "zlib":
+            try:
+                data = zlib.decompress(self.mm[image["offset"]:image["offset"] + image["length"]])
+            except zlib.error as e:
+                raise ValueError(f"バンドルの画像が壊れています ({e}): {self.path}") from e
+            argb = np.frombuffer(data, dtype=np.uint8).reshape(shape)
+        else:
+            argb = np.frombuffer(self.mm, dtype=np.uint8, count=image["length"], offset=image["offset"]).reshape(shape)
+        if self.swap_bytes:
+            argb = argb[..., ::-1].copy()
+            argb.flags.writeable = False
+        return argb
+
+    def rgba(self, i):
+        """i 番目の画像 (切り抜いた範囲) を乗算なしの RGBA 配列で返す"""
+        return argb32_to_rgba(self.argb32(i))
+
+    def frame_rgba(self, i):
+        """i 番目の画像を切り抜く前の大きさに戻した (周りは透明) RGBA 配列。縮小は書き出したときのまま"""
+        image = self.images[i]
+        frame = np.zeros((image["frame_height"], image["frame_width"], 4), dtype=np.uint8)
+        x, y = image["x"], image["y"]
+        frame[y:y + image["height"], x:x + image["width"]] = self.rgba(i)
+        return frame
+
+    def close(self):
+        # argb32() の配列が残っている間は閉じられないので、その場合は参照が無くなるのに任せる
+        try:
+            self.mm.close()
+        except BufferError:
+            pass
+
+
+def export_drug(db, drug_name, path, compress=True, workers=None, on_error=None, max_size=MAX_SIZE):
+    """登録画像をビューアと同じパラメータで透過処理してバンドルに書き出す。(書き出した件数, 失敗した件数)
+
+    各画像は max_size×max_size の表示に足りる大きさまで縮小する (None なら原寸)。
+    読めない画像は飛ばして on_error(元画像のパス, 例外) を呼ぶ。
+    """
+    entries = db.images_for_drug(drug_name)
+    if not entries:
+        return 0, 0
+    workers = workers or os.cpu_count()
+    written = failed = 0
+
+    def key(entry):
+        _id, _drug_name, image_path, target_rgb, tolerance, border_only, key_ranges = entry
+        try:
+            return keyed_argb32(image_path, target_rgb, tolerance, border_only, key_ranges, max_size)
+        except Exception as e:
+            return e
+
+    with BundleWriter(path, drug_name, compress) as writer, ThreadPoolExecutor(max_workers=workers) as executor:
+        # 先読みは workers 枚ずつにして、透過済みの配列を一度に抱えすぎないようにする
+        for start in range(0, len(entries), workers):
+            chunk = entries[start:start + workers]
+            for entry, keyed in zip(chunk, executor.map(key, chunk)):
+                _id, _drug_name, image_path, target_rgb, tolerance, border_only, key_ranges = entry
+                if isinstance(keyed, Exception):
+                    failed += 1
+                    if on_error:
+                        on_error(image_path, keyed)
+                    continue
+                argb, factor = keyed
+                writer.add(argb, image_path, target_rgb, tolerance, border_only, key_ranges, factor)
+                written += 1
+    return written, failed
+
+
+def folder_name(drug_name):
+    """薬剤名を 1 階層のフォルダ名にする (区切り文字や "..", 使えない文字を含む名前でも外に出ない)"""
+    name = "".join("_" if c in '<>:"/\\|?*' or ord(c) < 32 else c for c in drug_name).strip(" .")
+    return name or "_"
+
+
+def import_bundle(db, path, extract_dir, use_sources=False):
+    """バンドルの画像を extract_dir/薬剤名/ に PNG で書き出し、パラメータごと登録する。(登録した件数, 重複した件数)
+
+    use_sources=True なら、記録された元画像がまだあるものは書き出さずに元画像のパスで登録する。
+    bulk_import と同じく、内容 (SHA-1) が登録済みの画像と同じものは飛ばすので、同じバンドルを
+    取り込み直しても登録は増えない。
+    """
+    from bulk_import import known_hashes
+    from keyed_store import hash_file
+    from phash import keyed_phash, to_db
+
+    bundle = DrugBundle(path)
+    try:
+        directory = os.path.join(extract_dir, folder_name(bundle.drug_name))
+        with ThreadPoolExecutor() as executor:
+            seen, _cached = known_hashes(db, executor, 32)
+        rows = []
+        hashes = []
+        duplicates = 0
+        for i, (_id, drug_name, source_path, target_rgb, tolerance, border_only, key_ranges) in enumerate(
+                bundle.entries):
+            img = Image.fromarray(bundle.frame_rgba(i))
+            data = None
+            if use_sources and os.path.exists(source_path):
+                image_path = source_path
+                sha1 = hash_file(source_path)
+            else:
+                buffer = io.BytesIO()
+                img.save(buffer, "PNG", compress_level=1)
+                data = buffer.getvalue()
+                sha1 = hashlib.sha1(data).hexdigest()
+                # Named by content, so a different image never overwrites an earlier import
+                base = os.path.splitext(os.path.basename(source_path))[0]
+                image_path = os.path.abspath(os.path.join(directory, f"{base}_{sha1[:12]}.png"))
+            if sha1 in seen:
+                duplicates += 1
+                continue
+            seen.add(sha1)
+            if data is not None:
+                os.makedirs(directory, exist_ok=True)
+                tmp_path = f"{image_path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, image_path)
+            st = os.stat(image_path)
+            hashes.append((image_path, st.st_mtime_ns, st.st_size, sha1))
+            # 透過済みの画像に同じパラメータをかけ直しても結果は変わらない
+            phash = to_db(keyed_phash(img, target_rgb, tolerance, border_only, key_ranges))
+            rows.append((drug_name, image_path, target_rgb, tolerance, border_only, phash, key_ranges))
+        db.add_images(rows)
+        db.put_source_hashes(hashes)
+        return len(rows), duplicates
+    finally:
+        bundle.close()
@@ -0,0 +1,76 @@
+import os
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_str(name, default):
+    return os.environ.get(name, default)
+
+
+# デコード済み画像キャッシュのメモリ上限 (MB)
+DECODE_CACHE_MB = _env_int("SEATHR_DECODE_CACHE_MB", 512)
+
+# 距離マップキャッシュのメモリ上限 (MB)
+DISTANCE_CACHE_MB = _env_int("SEATHR_DISTANCE_CACHE_MB", 128)
+
+# スライダー操作から再描画までの待ち時間 (ms)
+SLIDER_DEBOUNCE_MS = _env_int("SEATHR_SLIDER_DEBOUNCE_MS", 30)
+
+# 薬剤の画像を前後何枚ずつ先読みするか
+PREFETCH_WINDOW = _env_int("SEATHR_PREFETCH_WINDOW", 2)
+
+# 先読みに使うメモリの上限 (MB)
+PREFETCH_MB = _env_int("SEATHR_PREFETCH_MB", 512)
+
+# 透過済み画像をディスクにキャッシュするか (0 で無効)
+KEYED_CACHE = _env_int("SEATHR_KEYED_CACHE", 1)
+
+# キャッシュの保存形式 ("png" または "webp"、どちらも可逆)
+KEYED_CACHE_FORMAT = _env_str("SEATHR_KEYED_CACHE_FORMAT", "png")
+
+# キャッシュのディスク使用量の上限 (MB、超えたら最後に使われたのが古いものから消す。0 なら上限なし)
+KEYED_CACHE_MB = _env_int("SEATHR_KEYED_CACHE_MB", 1024)
+
+# 表示サイズに縮小した画像で透過処理するか (0 なら常に原寸)
+PREVIEW_PROXY = _env_int("SEATHR_PREVIEW_PROXY", 1)
+
+# 表示サイズに縮小した画像のキャッシュ上限 (MB)
+SCALED_CACHE_MB = _env_int("SEATHR_SCALED_CACHE_MB", 64)
+
+# この画素数 (MP) 以上の画像は帯ごとに処理してメモリ使用量を抑える
+STREAMING_MIN_PIXELS = _env_int("SEATHR_STREAMING_MIN_MP", 64) * 1000 * 1000
+
+# 新しく開いた画像で、外周からつながる背景だけを透過するか (0 なら色が近い画素をすべて透過)
+BORDER_ONLY = _env_int("SEATHR_BORDER_ONLY", 0)
+
+# 透過・クロップ結果の保存形式 ("png" または "webp"、どちらも可逆)
+OUTPUT_FORMAT = _env_str("SEATHR_OUTPUT_FORMAT", "png")
+
+# 透過・クロップ結果を PNG で保存するときの圧縮レベル (0〜9、小さいほど速い)
+OUTPUT_COMPRESS_LEVEL = _env_int("SEATHR_OUTPUT_COMPRESS_LEVEL", 6)
+
+# 透過・クロップ結果をより小さくなるよう時間をかけて圧縮するか
+OUTPUT_OPTIMIZE = _env_int("SEATHR_OUTPUT_OPTIMIZE", 0)
+
+# 処理段階ごとの時間計測を有効にするか
+PROFILE = _env_int("SEATHR_PROFILE", 0)
+
+# 終了時の計測レポートの出力先 (空なら標準エラー出力)
+PROFILE_REPORT = _env_str("SEATHR_PROFILE_REPORT", "")
+
+# 起動時間 (最初の描画・最初の画像まで) を表示して終了するか (seathr.py --startup-time と同じ)
+STARTUP_TIME = _env_int("SEATHR_STARTUP_TIME", 0)
+
+# 登録画像のあるフォルダをいくつまで変更監視するか (超えたら INTEGRITY_POLL_S ごとに全件を確認する)
+WATCH_MAX_DIRS = _env_int("SEATHR_WATCH_MAX_DIRS", 2000)
+
+# フォルダを監視できないときに登録画像の有無を確認し直す間隔 (秒、0 なら起動時だけ)
+INTEGRITY_POLL_S = _env_int("SEATHR_INTEGRITY_POLL_S", 300)
+
+# 登録画像の有無を並列に確認するスレッド数
+INTEGRITY_WORKERS = _env_int("SEATHR_INTEGRITY_WORKERS", 8)
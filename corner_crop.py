@@ -0,0 +1,136 @@
+from collections import namedtuple
+from PIL import Image
+from keying import corner_color, key_color
+from streaming import STRIP_ROWS, border_background, corner_color_of, keyed_bbox, write_keyed_png
+import config
+import numpy as np
+import os
+import threading
+
+OUTPUT_STEM = "_transparent_cropped"
+OUTPUT_SUFFIX = OUTPUT_STEM + ".png"
+OUTPUT_EXTENSIONS = {"png": ".png", "webp": ".webp"}
+
+# format: "png" または "webp" (どちらも可逆), compress_level: PNG の zlib 圧縮レベル (0〜9),
+# optimize: PNG は最大圧縮で探索、WebP は最も時間をかけて圧縮する
+OutputOptions = namedtuple("OutputOptions", ["format", "compress_level", "optimize"])
+
+
+def default_output_options():
+    return OutputOptions(config.OUTPUT_FORMAT, config.OUTPUT_COMPRESS_LEVEL, bool(config.OUTPUT_OPTIMIZE))
+
+
+def save_options(options):
+    """OutputOptions を Image.save に渡す引数にする"""
+    if options.format == "webp":
+        # 可逆 WebP では quality と method が圧縮の手間を表す
+        return {"format": "WEBP", "lossless": True, "quality": 100 if options.optimize else 80,
+                "method": 6 if options.optimize else 4}
+    if options.format == "png":
+        return {"format": "PNG", "compress_level": options.compress_level, "optimize": options.optimize}
+    raise ValueError(f"未対応の保存形式です: {options.format}")
+
+
+def output_path_for(image_path, output_dir=None, image_format="png"):
+    base, ext = os.path.splitext(image_path)
+    output_path = base + OUTPUT_STEM + OUTPUT_EXTENSIONS[image_format]
+    if output_dir:
+        output_path = os.path.join(output_dir, os.path.basename(output_path))
+    return output_path
+
+
+def crop_by_corner(image_path, tolerance=30, border_only=False, max_size=None, key_ranges=()):
+    """四隅の背景色を透過し、非透過部分だけをクロップした RGBA 画像と背景色を返す（保存はしない）
+
+    max_size=(幅, 高さ) を渡すと、その大きさまで縮小してから処理する (プレビュー用)。
+    key_ranges の範囲に入る色 (影やグラデーションなど) も一緒に透過する。
+    """
+    with Image.open(image_path) as src:
+        if max_size:
+            src.draft(None, max_size)
+            src.thumbnail(max_size)
+        img = src.convert("RGBA")
+    rgba = np.array(img)
+
+    # 四隅の平均色を背景色と仮定
+    avg_color = corner_color(rgba)
+
+    key_color(rgba, avg_color, tolerance, border_only, key_ranges)  # 完全透過
+    img = Image.fromarray(rgba)
+
+    alpha = img.getchannel("A")
+    bbox = alpha.getbbox()
+    if bbox:
+        img = img.crop(bbox)
+    return img, avg_color
+
+
+def save_output(img, output_path, options=None):
+    """一時ファイルに書いてから置き換える（書きかけのファイルが見えないように）"""
+    if options is None:
+        options = default_output_options()
+    tmp_path = f"{output_path}.{threading.get_ident()}.tmp"
+    try:
+        img.save(tmp_path, **save_options(options))
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return output_path
+
+
+def use_streaming(image_path, options, streaming=None):
+    """帯ごとの処理で書き出すか。streaming=None なら画素数が config.STREAMING_MIN_PIXELS 以上のとき。
+    帯ごとに書けるのは PNG だけなので、WebP では常に False"""
+    if options.format != "png":
+        return False
+    if streaming is None:
+        with Image.open(image_path) as img:
+            streaming = img.width * img.height >= config.STREAMING_MIN_PIXELS
+    return streaming
+
+
+def auto_transparent_by_corner(image_path, tolerance=30, output_dir=None, verbose=True, streaming=None,
+                               border_only=False, options=None, key_ranges=()):
+    """四隅の背景色を透過し、非透過部分だけをクロップして保存
+
+    streaming=None のときは画素数が config.STREAMING_MIN_PIXELS 以上なら帯ごとの処理に切り替える。
+    border_only=True なら画像の外周からつながる背景だけを透過する（錠剤の中の白い部分は残す）。
+    options (OutputOptions) を省略すると config の保存形式で保存する。
+    """
+    if options is None:
+        options = default_output_options()
+    if use_streaming(image_path, options, streaming):
+        return auto_transparent_by_corner_streaming(
+            image_path, tolerance, output_dir, verbose, border_only=border_only,
+            compress_level=options.compress_level, key_ranges=key_ranges)
+
+    img, avg_color = crop_by_corner(image_path, tolerance, border_only, key_ranges=key_ranges)
+    if verbose:
+        print(f"推定背景色: {avg_color}")
+
+    output_path = save_output(img, output_path_for(image_path, output_dir, options.format), options)
+    if verbose:
+        print(f"保存完了: {output_path}")
+    return output_path
+
+
+def auto_transparent_by_corner_streaming(image_path, tolerance=30, output_dir=None, verbose=True,
+                                         strip_rows=STRIP_ROWS, border_only=False, compress_level=6, key_ranges=()):
+    """auto_transparent_by_corner と同じ結果を、帯ごとの処理で少ないメモリで作る (PNG のみ)"""
+    with Image.open(image_path) as img:
+        img.load()
+        avg_color = corner_color_of(img)
+        if verbose:
+            print(f"推定背景色: {avg_color}")
+
+        background = border_background(img, avg_color, tolerance, strip_rows, key_ranges) if border_only else None
+        # 1 周目で切り抜き範囲を求め、2 周目でその範囲だけを書き出す
+        bbox = keyed_bbox(img, avg_color, tolerance, strip_rows, background, key_ranges)
+        output_path = output_path_for(image_path, output_dir)
+        write_keyed_png(img, output_path, avg_color, tolerance, bbox, strip_rows, compress_level,
+                        background=background, key_ranges=key_ranges)
+    if verbose:
+        print(f"保存完了: {output_path}")
+    return output_path
@@ -0,0 +1,317 @@
+import contextlib
+import json
+import sqlite3
+
+from kana import query_prefixes, search_key
+from profiling import profiler
+
+
+def _rebuild_drug_index(conn):
+    # Search keys are computed in Python (kana.search_key), so this can't be plain SQL
+    names = conn.execute("SELECT DISTINCT drug_name FROM images").fetchall()
+    conn.execute("DELETE FROM drugs")
+    conn.executemany("INSERT INTO drugs (name, search_key) VALUES (?, ?)",
+                     ((name, search_key(name)) for (name,) in names))
+
+
+# (version, steps). A step is a SQL statement or a function taking the
+# connection. Each migration runs once, inside one explicit transaction
+# together with the PRAGMA user_version bump that records it, so a failed
+# step rolls back the whole migration (SQLite DDL is transactional).
+MIGRATIONS = [
+    (1, [
+        '''
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            drug_name TEXT NOT NULL,
+            image_path TEXT NOT NULL,
+            target_rgb_r INTEGER,
+            target_rgb_g INTEGER,
+            target_rgb_b INTEGER,
+            tolerance INTEGER
+        )
+        ''',
+    ]),
+    (2, [
+        # Serves both SELECT DISTINCT drug_name and the per-drug ORDER BY id query
+        "CREATE INDEX IF NOT EXISTS idx_images_drug_name ON images (drug_name, id)",
+    ]),
+    (3, [
+        # Content hash of each source file, keyed on the (path, mtime, size) it was computed for
+        '''
+        CREATE TABLE IF NOT EXISTS source_hashes (
+            image_path TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            sha1 TEXT NOT NULL
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_source_hashes_sha1 ON source_hashes (sha1)",
+    ]),
+    (4, [
+        # 1 = only clear background connected to the image border
+        "ALTER TABLE images ADD COLUMN border_only INTEGER NOT NULL DEFAULT 0",
+    ]),
+    (5, [
+        # One row per drug with its normalized name (kana.search_key) for prefix search
+        '''
+        CREATE TABLE IF NOT EXISTS drugs (
+            name TEXT PRIMARY KEY,
+            search_key TEXT NOT NULL
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_drugs_search_key ON drugs (search_key, name)",
+        _rebuild_drug_index,
+    ]),
+    (6, [
+        # 64-bit perceptual hash of the keyed, cropped image (phash.py), stored
+        # signed; NULL until computed
+        "ALTER TABLE images ADD COLUMN phash INTEGER",
+    ]),
+    (7, [
+        # Last seen state of each source file (integrity.CatalogMonitor):
+        # file_status 1 = present, 0 = missing, NULL = not checked yet
+        "ALTER TABLE images ADD COLUMN file_status INTEGER",
+        "ALTER TABLE images ADD COLUMN file_mtime_ns INTEGER",
+        "CREATE INDEX IF NOT EXISTS idx_images_image_path ON images (image_path)",
+    ]),
+    (8, [
+        # Extra colours keyed together with the target colour, as a JSON list of
+        # [[r_min, g_min, b_min], [r_max, g_max, b_max]] boxes; NULL = none
+        "ALTER TABLE images ADD COLUMN key_colors TEXT",
+    ]),
+]
+
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -65536",  # 64 MB
+    "PRAGMA mmap_size = 268435456",  # 256 MB
+]
+
+# sqlite3 keeps compiled statements per connection keyed by the SQL text,
+# so these are only prepared once for the lifetime of the connection
+SQL_DRUG_NAMES = "SELECT DISTINCT drug_name FROM images ORDER BY drug_name"
+SQL_IMAGES_FOR_DRUG = '''
+    SELECT id, drug_name, image_path, target_rgb_r, target_rgb_g, target_rgb_b, tolerance, border_only, key_colors
+    FROM images WHERE drug_name = ?
+    ORDER BY id
+'''
+SQL_INSERT_IMAGE = '''
+    INSERT INTO images (drug_name, image_path, target_rgb_r, target_rgb_g, target_rgb_b, tolerance, border_only, phash,
+                        key_colors)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+SQL_DELETE_IMAGE = "DELETE FROM images WHERE id = ?"
+SQL_IMAGE_PATHS = "SELECT DISTINCT image_path FROM images"
+SQL_SOURCE_HASHES = "SELECT image_path, mtime_ns, size, sha1 FROM source_hashes"
+SQL_PUT_SOURCE_HASH = '''
+    INSERT OR REPLACE INTO source_hashes (image_path, mtime_ns, size, sha1)
+    VALUES (?, ?, ?, ?)
+'''
+SQL_IMAGE_PHASHES = "SELECT id, phash FROM images WHERE phash IS NOT NULL"
+SQL_IMAGES_WITHOUT_PHASH = '''
+    SELECT id, image_path, target_rgb_r, target_rgb_g, target_rgb_b, tolerance, border_only, key_colors
+    FROM images WHERE phash IS NULL
+'''
+SQL_COUNT_IMAGES_WITHOUT_PHASH = "SELECT COUNT(*) FROM images WHERE phash IS NULL"
+SQL_SET_PHASH = "UPDATE images SET phash = ? WHERE id = ?"
+SQL_IMAGE_BY_ID = "SELECT id, drug_name, image_path FROM images WHERE id = ?"
+# Rows sharing a path carry the same state; the dict built from this dedupes them
+SQL_FILE_STATES = '''
+    SELECT image_path, file_status, file_mtime_ns FROM images
+    WHERE file_status IS NOT NULL
+'''
+SQL_SET_FILE_STATE = "UPDATE images SET file_status = ?, file_mtime_ns = ? WHERE image_path = ?"
+SQL_DRUG_OF_IMAGE = "SELECT drug_name FROM images WHERE id = ?"
+SQL_ADD_DRUG = "INSERT OR IGNORE INTO drugs (name, search_key) VALUES (?, ?)"
+SQL_DROP_UNUSED_DRUG = '''
+    DELETE FROM drugs WHERE name = ?
+    AND NOT EXISTS (SELECT 1 FROM images WHERE drug_name = ?)
+'''
+# One prefix range of the search index. Keyset paging: each page continues
+# after the (search_key, name) of the previous one, so a deep page costs the
+# same as the first
+SQL_SEARCH_DRUGS = '''
+    SELECT search_key, name FROM drugs
+    WHERE search_key >= ? AND search_key < ? AND (search_key, name) > (?, ?)
+    ORDER BY search_key, name
+    LIMIT ?
+'''
+
+
+def key_ranges_to_json(key_ranges):
+    """((r, g, b) の最小, (r, g, b) の最大) のタプルを key_colors 列の値にする (無ければ NULL)"""
+    return json.dumps([[list(lo), list(hi)] for lo, hi in key_ranges]) if key_ranges else None
+
+
+def key_ranges_from_json(text):
+    """key_colors 列の値を ((r, g, b), (r, g, b)) のタプルに戻す"""
+    if not text:
+        return ()
+    return tuple((tuple(lo), tuple(hi)) for lo, hi in json.loads(text))
+
+
+class CatalogDB:
+    """drugs.db への常時接続。sqlite3.Error はそのまま呼び出し元へ送出する"""
+
+    def __init__(self, path):
+        self.path = path
+        # Autocommit mode: sqlite3's implicit transactions don't cover DDL, so
+        # writes go through transaction() with an explicit BEGIN instead
+        self.conn = sqlite3.connect(path, cached_statements=256, isolation_level=None)
+        for pragma in PRAGMAS:
+            self.conn.execute(pragma)
+        self._migrate()
+
+    def _migrate(self):
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        for target_version, statements in MIGRATIONS:
+            if target_version <= version:
+                continue
+            with self.transaction():
+                for statement in statements:
+                    if callable(statement):
+                        statement(self.conn)
+                    else:
+                        self.conn.execute(statement)
+                self.conn.execute(f"PRAGMA user_version = {target_version}")
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ブロック内の書き込みを 1 トランザクションにする。例外が出たらロールバックして送出する"""
+        self.conn.execute("BEGIN")
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def drug_names(self):
+        with profiler.stage("sqlite"):
+            return [row[0] for row in self.conn.execute(SQL_DRUG_NAMES)]
+
+    def images_for_drug(self, drug_name):
+        """(id, drug_name, image_path, (r, g, b), tolerance, border_only, key_ranges) のリストを返す"""
+        with profiler.stage("sqlite"):
+            return [
+                (row[0], row[1], row[2], (row[3], row[4], row[5]), row[6], bool(row[7]), key_ranges_from_json(row[8]))
+                for row in self.conn.execute(SQL_IMAGES_FOR_DRUG, (drug_name,))
+            ]
+
+    def add_image(self, drug_name, image_path, target_rgb, tolerance, border_only=False, phash=None, key_ranges=()):
+        with profiler.stage("sqlite"), self.transaction():
+            cursor = self.conn.execute(SQL_INSERT_IMAGE, (
+                drug_name, image_path,
+                target_rgb[0], target_rgb[1], target_rgb[2],
+                tolerance, int(border_only), phash, key_ranges_to_json(key_ranges)
+            ))
+            self.conn.execute(SQL_ADD_DRUG, (drug_name, search_key(drug_name)))
+        return cursor.lastrowid
+
+    def add_images(self, rows):
+        """(drug_name, image_path, target_rgb, tolerance, border_only, phash, key_ranges) をまとめて
+        1 トランザクションで登録する"""
+        rows = list(rows)
+        with profiler.stage("sqlite"), self.transaction():
+            self.conn.executemany(SQL_INSERT_IMAGE, (
+                (drug_name, image_path, rgb[0], rgb[1], rgb[2], tolerance, int(border_only), phash,
+                 key_ranges_to_json(key_ranges))
+                for drug_name, image_path, rgb, tolerance, border_only, phash, key_ranges in rows
+            ))
+            self.conn.executemany(SQL_ADD_DRUG, (
+                (drug_name, search_key(drug_name)) for drug_name in {row[0] for row in rows}
+            ))
+
+    def image_paths(self):
+        with profiler.stage("sqlite"):
+            return [row[0] for row in self.conn.execute(SQL_IMAGE_PATHS)]
+
+    def source_hashes(self):
+        """{image_path: (mtime_ns, size, sha1)} (KeyedStore と共有する元画像のハッシュ)"""
+        with profiler.stage("sqlite"):
+            return {row[0]: (row[1], row[2], row[3]) for row in self.conn.execute(SQL_SOURCE_HASHES)}
+
+    def put_source_hashes(self, rows):
+        """(image_path, mtime_ns, size, sha1) をまとめて記録する"""
+        with profiler.stage("sqlite"), self.transaction():
+            self.conn.executemany(SQL_PUT_SOURCE_HASH, rows)
+
+    def image_phashes(self):
+        """知覚ハッシュを計算済みの画像の (id, phash) のリスト (phash は phash.to_db の符号付きの値)"""
+        with profiler.stage("sqlite"):
+            return self.conn.execute(SQL_IMAGE_PHASHES).fetchall()
+
+    def images_without_phash(self):
+        """知覚ハッシュが未計算の画像の (id, image_path, (r, g, b), tolerance, border_only, key_ranges) のリスト"""
+        with profiler.stage("sqlite"):
+            return [
+                (row[0], row[1], (row[2], row[3], row[4]), row[5], bool(row[6]), key_ranges_from_json(row[7]))
+                for row in self.conn.execute(SQL_IMAGES_WITHOUT_PHASH)
+            ]
+
+    def count_images_without_phash(self):
+        """知覚ハッシュが未計算の画像の件数"""
+        with profiler.stage("sqlite"):
+            return self.conn.execute(SQL_COUNT_IMAGES_WITHOUT_PHASH).fetchone()[0]
+
+    def set_phashes(self, rows):
+        """(phash, id) をまとめて記録する"""
+        with profiler.stage("sqlite"), self.transaction():
+            self.conn.executemany(SQL_SET_PHASH, rows)
+
+    def image_by_id(self, image_id):
+        """(id, drug_name, image_path)。無ければ None"""
+        with profiler.stage("sqlite"):
+            return self.conn.execute(SQL_IMAGE_BY_ID, (image_id,)).fetchone()
+
+    def file_states(self):
+        """{image_path: 更新時刻} (最後の確認でファイルが無かったものは None、未確認のものは含まない)"""
+        with profiler.stage("sqlite"):
+            return {
+                row[0]: row[2] if row[1] else None
+                for row in self.conn.execute(SQL_FILE_STATES)
+            }
+
+    def set_file_states(self, rows):
+        """(image_path, 更新時刻 または None) をまとめて記録する"""
+        with profiler.stage("sqlite"), self.transaction():
+            self.conn.executemany(SQL_SET_FILE_STATE, (
+                (int(mtime_ns is not None), mtime_ns, path) for path, mtime_ns in rows
+            ))
+
+    def delete_image(self, image_id):
+        with profiler.stage("sqlite"), self.transaction():
+            row = self.conn.execute(SQL_DRUG_OF_IMAGE, (image_id,)).fetchone()
+            self.conn.execute(SQL_DELETE_IMAGE, (image_id,))
+            if row:
+                self.conn.execute(SQL_DROP_UNUSED_DRUG, (row[0], row[0]))
+
+    def search_drugs(self, query, limit, after=("", "")):
+        """検索語に前方一致する薬剤名の (search_key, name) を最大 limit 件、検索キー順に返す
+
+        query はかな/カナ/ローマ字、全角/半角を問わない (kana.query_prefixes)。
+        after に前のページの最後の行を渡すとその続きを返す。
+        """
+        prefixes = query_prefixes(query)
+        params = []
+        for prefix in prefixes:
+            # prefix で始まる文字列は [prefix, prefix + U+10FFFF) に収まる
+            params += [prefix, prefix + "\U0010ffff", *after, limit]
+        sql = SQL_SEARCH_DRUGS
+        if len(prefixes) > 1:
+            # かなとローマ字の範囲をそれぞれ索引で引いてから合わせる
+            sql = " UNION ".join([f"SELECT * FROM ({SQL_SEARCH_DRUGS})"] * len(prefixes)) + " ORDER BY 1, 2 LIMIT ?"
+            params.append(limit)
+        with profiler.stage("sqlite"):
+            return self.conn.execute(sql, params).fetchall()
+
+    def rebuild_drug_index(self):
+        """images を直接書き換えた後に、薬剤名の検索用の表を作り直す"""
+        with profiler.stage("sqlite"), self.transaction():
+            _rebuild_drug_index(self.conn)
+
+    def close(self):
+        self.conn.close()
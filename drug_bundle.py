@@ -0,0 +1,99 @@
+"""薬剤ごとの透過済み画像をバンドル (.drugbundle) に書き出す・取り込む（Qt 不要）
+
+    python drug_bundle.py export ロキソニン -o loxonin.drugbundle   # 登録画像をまとめて書き出す
+    python drug_bundle.py import loxonin.drugbundle --extract-dir imported/
+    python drug_bundle.py list loxonin.drugbundle
+
+バンドルはビューア (seathr.py) でそのまま開ける。ファイルを 1 つ mmap するだけなので、
+ネットワーク共有上でも画像を切り替えるたびにファイルを開かずに済む。
+画像は不透明な範囲に切り抜き、表示に足りる大きさ (--max-size) まで縮小して zlib で軽く圧縮する。
+"""
+from bundle import EXTENSION, MAX_SIZE, DrugBundle, export_drug, import_bundle
+from db import CatalogDB
+import argparse
+import os
+import sys
+import time
+
+
+def export(db, args):
+    output = args.output or args.drug_name + EXTENSION
+    start = time.perf_counter()
+
+    def report(path, error):
+        print(f"エラー: {path}: {error}", file=sys.stderr)
+
+    written, failed = export_drug(db, args.drug_name, output, not args.raw, args.workers, report,
+                                  args.max_size or None)
+    if not written and not failed:
+        print(f"'{args.drug_name}' の画像は登録されていません。", file=sys.stderr)
+        return 1
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(output) if os.path.exists(output) else 0
+    print(f"完了: {written} 件書き出し, {failed} 件失敗 -> {output} ({size / 1024 / 1024:.1f} MB, {elapsed:.1f} 秒)")
+    return 1 if failed else 0
+
+
+def import_(db, args):
+    extract_dir = args.extract_dir or os.path.splitext(args.bundle)[0] + "_images"
+    start = time.perf_counter()
+    added, duplicates = import_bundle(db, args.bundle, extract_dir, args.use_sources)
+    print(f"完了: {added} 件登録, {duplicates} 件重複のためスキップ ({time.perf_counter() - start:.1f} 秒)")
+    return 0
+
+
+def list_(args):
+    bundle = DrugBundle(args.bundle)
+    try:
+        print(f"薬剤名: {bundle.drug_name} ({len(bundle)} 件)")
+        for image, (_id, _drug, source_path, target_rgb, tolerance, border_only, key_ranges) in zip(
+                bundle.images, bundle.entries):
+            mode = " 外周のみ" if border_only else ""
+            extra = f" 追加の透過色 {len(key_ranges)} 件" if key_ranges else ""
+            scale = f" (1/{image['factor']})" if image["factor"] > 1 else ""
+            print(f"  {image['width']}x{image['height']}{scale} {image['compression']:4s} "
+                  f"背景色 {target_rgb} 透過範囲 {tolerance}{mode}{extra}  {source_path}")
+    finally:
+        bundle.close()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="薬剤ごとの透過済み画像をバンドルに書き出す・取り込む")
+    parser.add_argument("--db", default="drugs.db", help="データベースファイル (既定: drugs.db)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="薬剤の登録画像を透過処理してバンドルに書き出す")
+    export_parser.add_argument("drug_name", help="薬剤名")
+    export_parser.add_argument("-o", "--output", help=f"出力ファイル (既定: 薬剤名{EXTENSION})")
+    export_parser.add_argument("--raw", action="store_true",
+                               help="画素を圧縮しない (大きくなるが、表示のたびに展開せずに済む。ローカルディスク向け)")
+    export_parser.add_argument("--max-size", type=int, default=MAX_SIZE,
+                               help=f"この大きさの表示に足りる範囲で縮小する (0 なら原寸、既定: {MAX_SIZE})")
+    export_parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="透過処理のスレッド数")
+
+    import_parser = commands.add_parser("import", help="バンドルの画像を drugs.db に登録する")
+    import_parser.add_argument("bundle", help="バンドルファイル")
+    import_parser.add_argument("--extract-dir", help="画像を書き出すディレクトリ (既定: バンドル名_images)")
+    import_parser.add_argument("--use-sources", action="store_true",
+                               help="元画像が残っていれば書き出さずに元画像のパスで登録する")
+
+    list_parser = commands.add_parser("list", help="バンドルの中身を表示する")
+    list_parser.add_argument("bundle", help="バンドルファイル")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "list":
+            return list_(args)
+        db = CatalogDB(args.db)
+        try:
+            return export(db, args) if args.command == "export" else import_(db, args)
+        finally:
+            db.close()
+    except (OSError, ValueError) as e:
+        print(f"エラー: {e}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
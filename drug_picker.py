@@ -0,0 +1,113 @@
+from PyQt6.QtCore import QAbstractListModel, QModelIndex, Qt, QTimer
+from PyQt6.QtWidgets import QDialog, QHBoxLayout, QLabel, QLineEdit, QListView, QPushButton, QVBoxLayout
+
+PAGE_SIZE = 200
+SEARCH_DELAY_MS = 150
+
+
+class DrugListModel(QAbstractListModel):
+    """CatalogDB.search_drugs の結果を、表示が進むたびに PAGE_SIZE 件ずつ読み込むモデル"""
+
+    def __init__(self, db, parent=None):
+        super().__init__(parent)
+        self.db = db
+        self.query = ""
+        self._rows = []  # (search_key, name)
+        self._exhausted = True
+
+    def set_query(self, query):
+        self.beginResetModel()
+        self.query = query
+        self._rows = self.db.search_drugs(query, PAGE_SIZE)
+        self._exhausted = len(self._rows) < PAGE_SIZE
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if index.isValid() and role == Qt.ItemDataRole.DisplayRole:
+            return self._rows[index.row()][1]
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self._exhausted
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+        page = self.db.search_drugs(self.query, PAGE_SIZE, self._rows[-1] if self._rows else ("", ""))
+        self._exhausted = len(page) < PAGE_SIZE
+        if page:
+            self.beginInsertRows(QModelIndex(), len(self._rows), len(self._rows) + len(page) - 1)
+            self._rows.extend(page)
+            self.endInsertRows()
+
+    def name_at(self, row):
+        return self._rows[row][1]
+
+
+class DrugPickerDialog(QDialog):
+    """薬剤名を検索して選ぶダイアログ。allow_new=True なら一覧に無い名前も入力できる"""
+
+    def __init__(self, db, title, allow_new=False, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle(title)
+        self.allow_new = allow_new
+
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("薬剤名 (かな・カナ・ローマ字で前方一致)")
+        self.model = DrugListModel(db, self)
+        self.list_view = QListView()
+        self.list_view.setModel(self.model)
+        self.list_view.setUniformItemSizes(True)  # 行の高さを測らずに済む
+        self.list_view.doubleClicked.connect(self.accept)
+
+        # Re-query once typing pauses instead of on every keystroke
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(SEARCH_DELAY_MS)
+        self.search_timer.timeout.connect(self._run_search)
+        self.search_input.textChanged.connect(self.search_timer.start)
+        self.search_input.returnPressed.connect(self._on_return)
+
+        layout = QVBoxLayout()
+        hint = "薬剤名を検索 (一覧に無い名前はそのまま入力すると新規登録):" if allow_new else "薬剤名を検索:"
+        layout.addWidget(QLabel(hint))
+        layout.addWidget(self.search_input)
+        layout.addWidget(self.list_view)
+        buttons_layout = QHBoxLayout()
+        ok_button = QPushButton("保存" if allow_new else "読み込む")
+        cancel_button = QPushButton("キャンセル")
+        ok_button.clicked.connect(self.accept)
+        cancel_button.clicked.connect(self.reject)
+        buttons_layout.addWidget(ok_button)
+        buttons_layout.addWidget(cancel_button)
+        layout.addLayout(buttons_layout)
+        self.setLayout(layout)
+
+        self._run_search()
+
+    def _run_search(self):
+        self.search_timer.stop()
+        self.model.set_query(self.search_input.text())
+        if self.model.rowCount() and not self.allow_new:
+            self.list_view.setCurrentIndex(self.model.index(0))
+
+    def _on_return(self):
+        if self.search_timer.isActive():
+            self._run_search()
+        self.accept()
+
+    def selected_name(self):
+        """選ばれた薬剤名。一覧の選択が無ければ (allow_new なら) 入力した名前、それも無ければ空文字"""
+        index = self.list_view.currentIndex()
+        if index.isValid() and self.list_view.selectionModel().isSelected(index):
+            return self.model.name_at(index.row())
+        if self.allow_new:
+            return self.search_input.text().strip()
+        return ""
+
+    def is_empty(self):
+        """検索語なしで 1 件も無い（薬剤が 1 つも登録されていない）か"""
+        return not self.search_input.text() and self.model.rowCount() == 0
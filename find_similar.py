@@ -0,0 +1,142 @@
+"""drugs.db から見た目の似ている画像を探す（Qt 不要）
+
+    python find_similar.py search photo.jpg -k 10      # 画像ファイルに似た登録画像
+    python find_similar.py search 123                  # 登録画像 ID 123 に似た登録画像
+    python find_similar.py duplicates --max-distance 4 # 別の薬剤名で登録された重複・ほぼ重複の組
+
+どのコマンドも、知覚ハッシュが未計算の登録画像があれば先に計算して drugs.db に記録する
+(update だけを実行することもできる)。
+"""
+from concurrent.futures import ProcessPoolExecutor
+from db import CatalogDB
+from phash import PhashIndex, corner_phash, file_phash, to_db
+import argparse
+import os
+import sys
+import time
+
+BATCH_SIZE = 1000
+
+
+def _compute(row):
+    """(id, 知覚ハッシュ)。読めなければ知覚ハッシュの代わりに例外の文字列"""
+    image_id, path, target_rgb, tolerance, border_only, key_ranges = row
+    try:
+        return image_id, to_db(file_phash(path, target_rgb, tolerance, border_only, key_ranges))
+    except Exception as e:
+        return image_id, f"{path}: {e}"
+
+
+def update_missing(db, workers=None, batch_size=BATCH_SIZE):
+    """知覚ハッシュが未計算の登録画像について計算して記録する。(計算した件数, 失敗した件数)"""
+    rows = db.images_without_phash()
+    if not rows:
+        return 0, 0
+    start = time.perf_counter()
+    done = failed = 0
+    pending = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for image_id, phash in executor.map(_compute, rows, chunksize=32):
+            done += 1
+            if isinstance(phash, str):
+                failed += 1
+                print(f"エラー: {phash}", file=sys.stderr)
+            else:
+                pending.append((phash, image_id))
+                if len(pending) >= batch_size:
+                    db.set_phashes(pending)
+                    pending.clear()
+            if done % 500 == 0 or done == len(rows):
+                elapsed = time.perf_counter() - start
+                print(f"[{done}/{len(rows)}] 知覚ハッシュを計算 ({done / elapsed:.1f} 枚/秒)", file=sys.stderr, flush=True)
+    db.set_phashes(pending)
+    return done - failed, failed
+
+
+def _describe(db, image_id):
+    row = db.image_by_id(image_id)
+    return f"{row[0]:>8}  {row[1]}  {row[2]}" if row else f"{image_id:>8}  (削除済み)"
+
+
+def search(db, args):
+    index = PhashIndex.from_db(db)
+    exclude = ()
+    if args.target.isdigit() and not os.path.exists(args.target):
+        image_id = int(args.target)
+        phash = dict(db.image_phashes()).get(image_id)
+        if phash is None:
+            print(f"ID {image_id} の画像は登録されていないか、知覚ハッシュを計算できませんでした。", file=sys.stderr)
+            return 1
+        exclude = (image_id,)
+    elif args.target_rgb:
+        phash = file_phash(args.target, args.target_rgb, args.tolerance, args.border_only)
+    else:
+        _, phash = corner_phash(args.target, args.tolerance, args.border_only)
+
+    start = time.perf_counter()
+    results = index.nearest(phash, args.k, args.max_distance, exclude)
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"{len(index)} 件から検索 ({elapsed:.1f} ms)", file=sys.stderr)
+    for image_id, distance in results:
+        print(f"{distance:>3}  {_describe(db, image_id)}")
+    return 0
+
+
+def duplicates(db, args):
+    index = PhashIndex.from_db(db)
+    start = time.perf_counter()
+    pairs = index.near_duplicates(args.max_distance)
+    elapsed = (time.perf_counter() - start) * 1000
+    shown = 0
+    for a, b, distance in pairs:
+        row_a, row_b = db.image_by_id(a), db.image_by_id(b)
+        if not args.same_drug and row_a[1] == row_b[1]:
+            continue
+        shown += 1
+        print(f"{distance:>3}  {row_a[0]:>8}  {row_a[1]}  {row_a[2]}")
+        print(f"     {row_b[0]:>8}  {row_b[1]}  {row_b[2]}")
+    print(f"{len(index)} 件中 {shown} 組 ({elapsed:.1f} ms)", file=sys.stderr)
+    return 0
+
+
+def _rgb(text):
+    values = tuple(int(v) for v in text.split(","))
+    if len(values) != 3 or not all(0 <= v <= 255 for v in values):
+        raise argparse.ArgumentTypeError("R,G,B の形式で 0〜255 の値を指定してください")
+    return values
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="drugs.db から見た目の似ている画像を探す")
+    parser.add_argument("--db", default="drugs.db", help="データベースファイル (既定: drugs.db)")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="知覚ハッシュを計算するワーカープロセス数")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("update", help="未計算の知覚ハッシュを計算して記録する")
+
+    search_parser = commands.add_parser("search", help="画像ファイルまたは登録画像 ID に似た画像を探す")
+    search_parser.add_argument("target", help="画像ファイルのパス、または登録画像の ID")
+    search_parser.add_argument("-k", type=int, default=10, help="表示する件数 (既定: 10)")
+    search_parser.add_argument("--max-distance", type=int, help="これより遠い (ハミング距離が大きい) 画像は表示しない")
+    search_parser.add_argument("-t", "--tolerance", type=int, default=30, help="画像ファイルを透過する範囲 (既定: 30)")
+    search_parser.add_argument("--target-rgb", type=_rgb, help="画像ファイルの背景色 R,G,B (既定: 四隅の平均色)")
+    search_parser.add_argument("--border-only", action="store_true", help="外周につながる背景だけを透過する")
+
+    duplicates_parser = commands.add_parser("duplicates", help="重複・ほぼ重複の登録画像の組を探す")
+    duplicates_parser.add_argument("--max-distance", type=int, default=4, help="重複とみなすハミング距離 (既定: 4)")
+    duplicates_parser.add_argument("--same-drug", action="store_true", help="同じ薬剤名どうしの組も表示する")
+    args = parser.parse_args(argv)
+
+    db = CatalogDB(args.db)
+    try:
+        computed, failed = update_missing(db, args.workers)
+        if args.command == "update":
+            print(f"完了: {computed} 件計算, {failed} 件失敗")
+            return 1 if failed else 0
+        return search(db, args) if args.command == "search" else duplicates(db, args)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+from keying import distance_map
+from lru import BoundedLRU
+from profiling import profiler
+
+# プレビュー用に使う縮小率（2 の累乗）
+PROXY_FACTORS = (1, 2, 4, 8, 16, 32)
+
+
+def file_key(path):
+    """キャッシュキー (絶対パス, 更新時刻, サイズ) を返す。ファイルが無ければ FileNotFoundError"""
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+
+def proxy_factor(image_size, display_size):
+    """縮小しても表示サイズ以上の解像度が残る最大の縮小率を返す"""
+    width, height = image_size
+    display_width, display_height = display_size
+    if width <= 0 or height <= 0 or display_width <= 0 or display_height <= 0:
+        return 1
+    scale = min(display_width / width, display_height / height)
+    factor = 1
+    for candidate in PROXY_FACTORS[1:]:
+        if candidate * scale > 1:
+            break
+        factor = candidate
+    return factor
+
+
+def reduce_on_decode(img, factor):
+    """PIL 画像を 1/factor に縮小する (JPEG はデコード時に縮小するので速い)"""
+    target = (max(1, -(-img.width // factor)), max(1, -(-img.height // factor)))
+    img.draft(None, target)  # JPEG はデコード時に 1/2〜1/8 で読める（他の形式では何もしない）
+    remaining = min(img.width // target[0], img.height // target[1])
+    if remaining > 1:
+        img = img.reduce(remaining)
+    return img
+
+
+class DecodedImageCache:
+    """デコード済み RGBA 配列 (H×W×4, uint8, 読み取り専用) のキャッシュ
+
+    factor > 1 のときは 1/factor に縮小したプレビュー用の配列を別エントリとして持つ。
+    """
+
+    def __init__(self, max_bytes):
+        self._lru = BoundedLRU(max_bytes)
+        self._latest_keys = {}  # 絶対パス -> 最新のキー
+        self._sizes = {}  # キー -> 原寸 (幅, 高さ)
+        self._opaque = {}  # (キー, 縮小率) -> 元画像に透過情報が無いか
+        self._lock = threading.Lock()
+
+    def get(self, path, key=None, factor=1):
+        if key is None:
+            key = file_key(path)
+        rgba = self._lru.get((key, factor))
+        if rgba is None:
+            with profiler.stage("decode"), Image.open(path) as img:
+                if factor > 1:
+                    img = reduce_on_decode(img, factor)
+                opaque = not img.has_transparency_data
+                rgba = np.array(img.convert("RGBA"))
+            rgba.flags.writeable = False
+            with self._lock:
+                self._opaque[(key, factor)] = opaque
+            self._lru.put((key, factor), rgba)
+        self._forget_stale(key)
+        return rgba
+
+    def is_opaque(self, key, factor=1):
+        """get() で読んだ画像に半透明の画素が無いことが分かっていれば True"""
+        with self._lock:
+            return self._opaque.get((key, factor), False)
+
+    def image_size(self, path, key):
+        """ヘッダーだけを読んで原寸を返す"""
+        with self._lock:
+            size = self._sizes.get(key)
+        if size is None:
+            with Image.open(path) as img:
+                size = img.size
+            with self._lock:
+                self._sizes[key] = size
+            self._forget_stale(key)
+        return size
+
+    def _forget_stale(self, key):
+        # ファイルが更新されていたら古いデコード結果を捨てる
+        with self._lock:
+            old_key = self._latest_keys.get(key[0])
+            self._latest_keys[key[0]] = key
+            if old_key is not None and old_key != key:
+                self._sizes.pop(old_key, None)
+                for factor in PROXY_FACTORS:
+                    self._opaque.pop((old_key, factor), None)
+        if old_key is not None and old_key != key:
+            for factor in PROXY_FACTORS:
+                self._lru.discard((old_key, factor))
+
+    def forget(self, path):
+        """path の画像のエントリをすべて捨てる (ファイルが変わった・消えたとき)"""
+        path = os.path.abspath(path)
+        self._lru.discard_where(lambda cache_key: cache_key[0][0] == path)
+        with self._lock:
+            self._latest_keys.pop(path, None)
+            for key in [key for key in self._sizes if key[0] == path]:
+                del self._sizes[key]
+            for key in [key for key in self._opaque if key[0][0] == path]:
+                del self._opaque[key]
+
+    def clear(self):
+        self._lru.clear()
+        with self._lock:
+            self._latest_keys.clear()
+            self._sizes.clear()
+            self._opaque.clear()
+
+
+class DistanceMapCache:
+    """画像と透過色 (と追加の透過色の範囲) ごとの距離マップ (uint8, H×W) のキャッシュ"""
+
+    def __init__(self, max_bytes):
+        self._lru = BoundedLRU(max_bytes)
+
+    def get(self, key, rgba, target_rgb, key_ranges=()):
+        cache_key = (key, tuple(target_rgb), tuple(key_ranges))
+        dist = self._lru.get(cache_key)
+        if dist is None:
+            with profiler.stage("distance_map"):
+                dist = distance_map(rgba, target_rgb, key_ranges)
+            dist.flags.writeable = False
+            self._lru.put(cache_key, dist)
+        return dist
+
+    def forget(self, path):
+        path = os.path.abspath(path)
+        self._lru.discard_where(lambda cache_key: cache_key[0][0][0] == path)
+
+    def clear(self):
+        self._lru.clear()
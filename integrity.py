@@ -0,0 +1,197 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt6.QtCore import QFileSystemWatcher, QObject, QRunnable, QThreadPool, QTimer, pyqtSignal
+
+import config
+
+BATCH_SIZE = 500
+# 起動時のフォルダの監視を、GUI スレッドで一度に何件ずつ追加するか
+WATCH_CHUNK = 50
+# フォルダの変更通知をまとめてから確認するまでの待ち時間 (ms)
+WATCH_DELAY_MS = 500
+
+
+def stat_mtime(path):
+    """(パス, 更新時刻)。ファイルが無ければ更新時刻は None、それ以外の理由で調べられなければ None を返す"""
+    try:
+        return path, os.stat(path).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError):
+        return path, None
+    except OSError:
+        return None
+
+
+class ScanSignals(QObject):
+    checked = pyqtSignal(int, list)  # generation, [(path, mtime_ns or None)]
+    dirs_found = pyqtSignal(int, list)  # generation, existing directories of the scanned paths
+
+
+class ScanJob(QRunnable):
+    """paths を BATCH_SIZE 件ずつ並列に stat して、バッチごとに結果を送る
+
+    find_dirs=True なら、先に paths のあるフォルダのうち存在するものを dirs_found で送る。
+    """
+
+    def __init__(self, monitor, generation, paths, workers, find_dirs=False):
+        super().__init__()
+        self.monitor = monitor
+        self.generation = generation
+        self.paths = paths
+        self.workers = workers
+        self.find_dirs = find_dirs
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            if self.find_dirs:
+                dirs = list(dict.fromkeys(os.path.dirname(path) for path in self.paths))
+                found = [d for d, exists in zip(dirs, executor.map(os.path.isdir, dirs)) if exists]
+                self.monitor.signals.dirs_found.emit(self.generation, found)
+            for start in range(0, len(self.paths), BATCH_SIZE):
+                if self.generation != self.monitor.generation:
+                    return  # stop() が呼ばれた
+                rows = [row for row in executor.map(stat_mtime, self.paths[start:start + BATCH_SIZE]) if row]
+                self.monitor.signals.checked.emit(self.generation, rows)
+
+
+class CatalogMonitor(QObject):
+    """登録画像のファイルの有無と更新時刻を DB に記録し、変わったものを changed で知らせる
+
+    状態は GUI スレッドだけが読み書きする。画像のあるフォルダを QFileSystemWatcher で
+    監視し (多すぎるときは INTEGRITY_POLL_S ごとに全件を確認)、表示中の薬剤の画像は
+    ファイル自体も監視して上書きに気付けるようにする。
+    """
+
+    changed = pyqtSignal(list)  # [(path, mtime_ns or None)] of paths whose known state changed
+
+    def __init__(self, db, parent=None):
+        super().__init__(parent)
+        self.db = db
+        # 確認済みのパス -> 更新時刻 (無ければ None)。まだ確認していないパスは含まない
+        self.states = db.file_states()
+        self.generation = 0
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self.signals = ScanSignals(self)
+        self.signals.checked.connect(self._on_checked)
+        self.signals.dirs_found.connect(self._on_dirs_found)
+
+        self.paths_by_dir = {}
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self._on_directory_changed)
+        self.watcher.fileChanged.connect(lambda path: self.scan([path]))
+        self.watched_files = set()
+        self.pending_dirs = set()
+        self.watch_timer = QTimer(self)
+        self.watch_timer.setSingleShot(True)
+        self.watch_timer.setInterval(WATCH_DELAY_MS)
+        self.watch_timer.timeout.connect(self._scan_pending_dirs)
+        self.poll_timer = QTimer(self)
+        self.poll_timer.timeout.connect(self.scan)
+        # Each addPaths call touches the disk, so the start-up watches are
+        # added a chunk per event-loop pass
+        self.dirs_to_watch = []
+        self.add_watch_timer = QTimer(self)
+        self.add_watch_timer.setInterval(0)
+        self.add_watch_timer.timeout.connect(self._add_watch_chunk)
+
+    def is_missing(self, path):
+        """最後の確認でファイルが無かったか (ディスクには触らない)"""
+        return path in self.states and self.states[path] is None
+
+    def start(self):
+        """全件の確認を始め、フォルダの監視 (できなければ定期的な確認) を設定する
+
+        フォルダの有無はディスクに触るので ScanJob で調べ、監視は結果が届いてから追加する。
+        """
+        paths = self.db.image_paths()
+        for path in paths:
+            self.paths_by_dir.setdefault(os.path.dirname(path), []).append(path)
+        if paths:
+            self.pool.start(ScanJob(self, self.generation, paths, config.INTEGRITY_WORKERS, find_dirs=True))
+
+    def scan(self, paths=None):
+        """paths (省略時は登録画像すべて) をバックグラウンドで確認する"""
+        if paths is None:
+            paths = self.db.image_paths()
+        if paths:
+            self.pool.start(ScanJob(self, self.generation, list(paths), config.INTEGRITY_WORKERS))
+
+    def add_path(self, path):
+        """新しく登録した画像を監視対象に加えて確認する"""
+        directory = os.path.dirname(path)
+        if directory not in self.paths_by_dir and not self.poll_timer.isActive():
+            self.watcher.addPath(directory)
+        self.paths_by_dir.setdefault(directory, []).append(path)
+        self.scan([path])
+
+    def watch_files(self, paths):
+        """表示中の薬剤の画像を、上書きにも気付けるようにファイル単位で監視する"""
+        paths = set(paths)
+        stale = self.watched_files - paths
+        if stale:
+            self.watcher.removePaths(list(stale))
+        fresh = [path for path in paths - self.watched_files if self.states.get(path) is not None]
+        if fresh:
+            self.watcher.addPaths(fresh)
+        self.watched_files = paths
+
+    def stop(self):
+        self.generation += 1
+        self.poll_timer.stop()
+        self.watch_timer.stop()
+        self.add_watch_timer.stop()
+        self.pool.clear()
+        self.pool.waitForDone()
+
+    def _on_dirs_found(self, generation, dirs):
+        if generation != self.generation:
+            return
+        if len(dirs) > config.WATCH_MAX_DIRS:
+            self._start_polling()
+        else:
+            self.dirs_to_watch = dirs
+            self.add_watch_timer.start()
+
+    def _add_watch_chunk(self):
+        chunk = self.dirs_to_watch[:WATCH_CHUNK]
+        del self.dirs_to_watch[:WATCH_CHUNK]
+        if not self.dirs_to_watch:
+            self.add_watch_timer.stop()
+        if chunk and self.watcher.addPaths(chunk):
+            # Some directory can't be watched; checking everything periodically covers it
+            self.dirs_to_watch = []
+            self.add_watch_timer.stop()
+            self._start_polling()
+
+    def _start_polling(self):
+        if config.INTEGRITY_POLL_S > 0:
+            self.poll_timer.start(config.INTEGRITY_POLL_S * 1000)
+
+    def _on_directory_changed(self, directory):
+        self.pending_dirs.add(directory)
+        self.watch_timer.start()
+
+    def _scan_pending_dirs(self):
+        paths = [path for directory in self.pending_dirs for path in self.paths_by_dir.get(directory, ())]
+        self.pending_dirs.clear()
+        self.scan(paths)
+
+    def _on_checked(self, generation, rows):
+        if generation != self.generation:
+            return
+        changed = [(path, mtime_ns) for path, mtime_ns in rows
+                   if path not in self.states or self.states[path] != mtime_ns]
+        if not changed:
+            return
+        self.db.set_file_states(changed)
+        # Paths seen for the first time have nothing cached that could be stale
+        modified = [row for row in changed if row[0] in self.states]
+        self.states.update(changed)
+        # A file replaced by a rename drops out of the watcher; watch the new one
+        rewatch = [path for path, mtime_ns in changed
+                   if path in self.watched_files and mtime_ns is not None and path not in self.watcher.files()]
+        if rewatch:
+            self.watcher.addPaths(rewatch)
+        if modified:
+            self.changed.emit(modified)
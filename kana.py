@@ -0,0 +1,95 @@
+"""薬剤名検索のための文字列の正規化（かな・ローマ字）
+
+検索キーは NFKC で全角/半角をそろえ、小文字にし、カタカナをひらがなにしたもの。
+ローマ字で入力された検索語はひらがなにも変換して、かなの薬剤名にも前方一致させる。
+"""
+import re
+import unicodedata
+
+_ROMAJI = {
+    "a": "あ", "i": "い", "u": "う", "e": "え", "o": "お",
+    "ka": "か", "ki": "き", "ku": "く", "ke": "け", "ko": "こ",
+    "ga": "が", "gi": "ぎ", "gu": "ぐ", "ge": "げ", "go": "ご",
+    "sa": "さ", "si": "し", "shi": "し", "su": "す", "se": "せ", "so": "そ",
+    "za": "ざ", "zi": "じ", "ji": "じ", "zu": "ず", "ze": "ぜ", "zo": "ぞ",
+    "ta": "た", "ti": "ち", "chi": "ち", "tu": "つ", "tsu": "つ", "te": "て", "to": "と",
+    "da": "だ", "di": "ぢ", "du": "づ", "de": "で", "do": "ど",
+    "na": "な", "ni": "に", "nu": "ぬ", "ne": "ね", "no": "の",
+    "ha": "は", "hi": "ひ", "hu": "ふ", "fu": "ふ", "he": "へ", "ho": "ほ",
+    "ba": "ば", "bi": "び", "bu": "ぶ", "be": "べ", "bo": "ぼ",
+    "pa": "ぱ", "pi": "ぴ", "pu": "ぷ", "pe": "ぺ", "po": "ぽ",
+    "ma": "ま", "mi": "み", "mu": "む", "me": "め", "mo": "も",
+    "ya": "や", "yu": "ゆ", "yo": "よ",
+    "ra": "ら", "ri": "り", "ru": "る", "re": "れ", "ro": "ろ",
+    "wa": "わ", "wo": "を", "nn": "ん", "n'": "ん",
+    "kya": "きゃ", "kyu": "きゅ", "kyo": "きょ", "gya": "ぎゃ", "gyu": "ぎゅ", "gyo": "ぎょ",
+    "sya": "しゃ", "syu": "しゅ", "syo": "しょ", "sha": "しゃ", "shu": "しゅ", "sho": "しょ", "she": "しぇ",
+    "zya": "じゃ", "zyu": "じゅ", "zyo": "じょ", "ja": "じゃ", "ju": "じゅ", "jo": "じょ", "je": "じぇ",
+    "jya": "じゃ", "jyu": "じゅ", "jyo": "じょ",
+    "tya": "ちゃ", "tyu": "ちゅ", "tyo": "ちょ", "cha": "ちゃ", "chu": "ちゅ", "cho": "ちょ", "che": "ちぇ",
+    "nya": "にゃ", "nyu": "にゅ", "nyo": "にょ", "hya": "ひゃ", "hyu": "ひゅ", "hyo": "ひょ",
+    "bya": "びゃ", "byu": "びゅ", "byo": "びょ", "pya": "ぴゃ", "pyu": "ぴゅ", "pyo": "ぴょ",
+    "mya": "みゃ", "myu": "みゅ", "myo": "みょ", "rya": "りゃ", "ryu": "りゅ", "ryo": "りょ",
+    # 外来語によく出る組み合わせ
+    "fa": "ふぁ", "fi": "ふぃ", "fe": "ふぇ", "fo": "ふぉ", "fyu": "ふゅ",
+    "va": "ゔぁ", "vi": "ゔぃ", "vu": "ゔ", "ve": "ゔぇ", "vo": "ゔぉ",
+    "thi": "てぃ", "dhi": "でぃ", "twu": "とぅ", "dwu": "どぅ",
+    "wi": "うぃ", "we": "うぇ", "tsa": "つぁ", "tsi": "つぃ", "tse": "つぇ", "tso": "つぉ",
+    "xa": "ぁ", "xi": "ぃ", "xu": "ぅ", "xe": "ぇ", "xo": "ぉ",
+    "xya": "ゃ", "xyu": "ゅ", "xyo": "ょ", "xtu": "っ", "-": "ー",
+}
+_ROMAJI_MAX = max(len(k) for k in _ROMAJI)
+_SPACES = re.compile(r"\s+")
+
+
+def _katakana_to_hiragana(text):
+    # ァ (U+30A1) 〜 ヶ (U+30F6) はひらがなの同じ位置から 0x60 ずれている
+    return "".join(chr(ord(c) - 0x60) if "ァ" <= c <= "ヶ" else c for c in text)
+
+
+def search_key(text):
+    """薬剤名・検索語の比較用の形（全角/半角・大文字/小文字・カタカナ/ひらがなの違いをなくす）"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return _katakana_to_hiragana(_SPACES.sub("", text))
+
+
+def romaji_to_hiragana(text):
+    """ローマ字をひらがなにする。末尾の入力途中の子音は捨てる（前方一致に使うため）
+
+    ひらがなにできない文字が途中にあれば None を返す。
+    """
+    text = search_key(text)
+    out = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        nxt = text[i + 1] if i + 1 < len(text) else ""
+        if c == "n" and nxt and nxt not in "aiueoyn'":
+            out.append("ん")
+            i += 1
+            continue
+        if c == nxt and c.isalpha() and c not in "aiueon":
+            out.append("っ")  # 子音の重ね (kk, tt, ...) は促音
+            i += 1
+            continue
+        for length in range(min(_ROMAJI_MAX, len(text) - i), 0, -1):
+            kana = _ROMAJI.get(text[i:i + length])
+            if kana:
+                out.append(kana)
+                i += length
+                break
+        else:
+            if text[i:].isalpha() and text[i:].isascii():
+                break  # "asupir" の "r" のような入力途中の子音
+            return None
+    return "".join(out)
+
+
+def query_prefixes(query):
+    """検索語から、検索キーの前方一致に使う接頭辞を返す（重複なし）"""
+    prefixes = [search_key(query)]
+    if prefixes[0].isascii():
+        kana = romaji_to_hiragana(query)
+        if kana and kana not in prefixes:
+            prefixes.append(kana)
+    return prefixes
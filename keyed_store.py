@@ -0,0 +1,164 @@
+import glob
+import hashlib
+import os
+import sqlite3
+import threading
+
+from PIL import Image
+
+from db import SQL_PUT_SOURCE_HASH, key_ranges_to_json
+from streaming import border_background, write_keyed_png
+
+SQL_GET_SOURCE_HASH = "SELECT sha1, mtime_ns, size FROM source_hashes WHERE image_path = ?"
+SQL_COUNT_SHA1 = "SELECT COUNT(*) FROM source_hashes WHERE sha1 = ?"
+
+SAVE_OPTIONS = {
+    "png": {"format": "PNG", "compress_level": 1},
+    "webp": {"format": "WEBP", "lossless": True, "method": 0},
+}
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class KeyedStore:
+    """透過済み画像のサイドカーキャッシュ。
+
+    ファイル名は元画像の SHA-1 + 透過色 + 許容値 (+ 外周のみなら "b"、追加の透過色があればそのハッシュ、
+    縮小したプレビューなら縮小率) なので、元画像が変わればキーも変わる。
+    元画像のハッシュは (パス, 更新時刻, サイズ) ごとに drugs.db の source_hashes に記録する。
+    合計が max_bytes を超えたら、最後に使われたのが古いものから消す。
+    ワーカースレッドから呼ばれるため専用の接続をロック付きで使う。
+    """
+
+    def __init__(self, db_path, directory, image_format="png", max_bytes=None):
+        self.directory = directory
+        self.image_format = image_format if image_format in SAVE_OPTIONS else "png"
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._size_lock = threading.Lock()
+        self._total_bytes = None  # Counted by the first write, which runs on a worker
+
+    def source_hash(self, path, key):
+        abspath, mtime_ns, size = key
+        with self._lock:
+            row = self.conn.execute(SQL_GET_SOURCE_HASH, (abspath,)).fetchone()
+        if row and row[1] == mtime_ns and row[2] == size:
+            return row[0]
+
+        sha1 = hash_file(path)
+        with self._lock:
+            with self.conn:
+                self.conn.execute(SQL_PUT_SOURCE_HASH, (abspath, mtime_ns, size, sha1))
+            still_used = row and self.conn.execute(SQL_COUNT_SHA1, (row[0],)).fetchone()[0]
+        if row and row[0] != sha1 and not still_used:
+            # 元画像が書き換えられたので古い透過結果を消す
+            for stale in glob.glob(os.path.join(self.directory, f"{row[0]}_*")):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+        return sha1
+
+    def entry_path(self, sha1, target_rgb, tolerance, border_only=False, key_ranges=(), factor=1):
+        r, g, b = target_rgb
+        mode = "b" if border_only else ""
+        if key_ranges:
+            mode += "_k" + hashlib.sha1(key_ranges_to_json(key_ranges).encode()).hexdigest()[:12]
+        if factor > 1:
+            mode += f"_f{factor}"
+        return os.path.join(self.directory, f"{sha1}_{r:02x}{g:02x}{b:02x}_{tolerance}{mode}.{self.image_format}")
+
+    def lookup(self, path, key, target_rgb, tolerance, border_only=False, key_ranges=(), factor=1):
+        """1/factor に縮小した透過済み画像のキャッシュ済みファイルのパスを返す。無ければ None"""
+        entry = self.entry_path(self.source_hash(path, key), target_rgb, tolerance, border_only, key_ranges, factor)
+        try:
+            # Doubles as the existence check; the new mtime marks the entry as recently used
+            os.utime(entry)
+        except FileNotFoundError:
+            return None
+        except OSError:
+            pass
+        return entry
+
+    def put(self, path, key, target_rgb, tolerance, data, width, height, border_only=False, key_ranges=(),
+            factor=1):
+        entry = self.entry_path(self.source_hash(path, key), target_rgb, tolerance, border_only, key_ranges, factor)
+        if os.path.exists(entry):
+            return entry
+        tmp_path = f"{entry}.{threading.get_ident()}.tmp"
+        img = Image.frombuffer("RGBA", (width, height), data, "raw", "RGBA", 0, 1)
+        img.save(tmp_path, **SAVE_OPTIONS[self.image_format])
+        os.replace(tmp_path, entry)
+        self._added(entry)
+        return entry
+
+    def put_streaming(self, path, key, target_rgb, tolerance, border_only=False, key_ranges=()):
+        """元画像を帯ごとに透過処理して書き込む（巨大な画像用。PNG のみ）"""
+        entry = self.entry_path(self.source_hash(path, key), target_rgb, tolerance, border_only, key_ranges)
+        if os.path.exists(entry):
+            return entry
+        tmp_path = f"{entry}.{threading.get_ident()}.tmp"
+        with Image.open(path) as img:
+            img.load()
+            background = (border_background(img, target_rgb, tolerance, key_ranges=key_ranges)
+                          if border_only else None)
+            write_keyed_png(img, tmp_path, target_rgb, tolerance,
+                            compress_level=SAVE_OPTIONS["png"]["compress_level"], background=background,
+                            key_ranges=key_ranges)
+        os.replace(tmp_path, entry)
+        self._added(entry)
+        return entry
+
+    def _entries(self):
+        # (path, size, mtime) of every finished entry; .tmp files are still being written
+        suffixes = tuple("." + image_format for image_format in SAVE_OPTIONS)
+        entries = []
+        with os.scandir(self.directory) as it:
+            for dir_entry in it:
+                if dir_entry.name.endswith(suffixes):
+                    try:
+                        st = dir_entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((dir_entry.path, st.st_size, st.st_mtime))
+        return entries
+
+    def _added(self, entry):
+        if not self.max_bytes:
+            return
+        with self._size_lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _path, size, _mtime in self._entries())
+            else:
+                try:
+                    self._total_bytes += os.path.getsize(entry)
+                except OSError:
+                    return
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Drop least recently used entries down to 90% of the limit, so the
+        # directory isn't rescanned on every write near the limit
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _path, size, _mtime in entries)
+        for path, size, _mtime in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self._total_bytes = total
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,227 @@
+import functools
+import sys
+
+import numpy as np
+from PIL import Image
+
+# QImage.Format_ARGB32_Premultiplied は 32bit 値 0xAARRGGBB なので、メモリ上の並びは
+# エンディアンで変わる。出力の各バイトに入れる RGBA のチャンネル番号
+ARGB32_ORDER = (2, 1, 0, 3) if sys.byteorder == "little" else (3, 0, 1, 2)
+
+# PREMULTIPLY_LUT[a, c] = round(c * a / 255)
+PREMULTIPLY_LUT = (
+    (np.arange(256, dtype=np.uint32)[:, None] * np.arange(256, dtype=np.uint32)[None, :] + 127) // 255
+).astype(np.uint8)
+
+
+def _abs_diff_lut(value):
+    # 0..255 の各値と value との差の絶対値 (uint8)
+    return np.abs(np.arange(256, dtype=np.int16) - value).astype(np.uint8)
+
+
+def color_range(rgb, tolerance):
+    """rgb から距離 tolerance 以内の色の範囲 ((r, g, b) の最小, (r, g, b) の最大)"""
+    return (tuple(max(v - tolerance, 0) for v in rgb), tuple(min(v + tolerance, 255) for v in rgb))
+
+
+@functools.lru_cache(maxsize=2)
+def rgb_distance_lut(target_rgb, key_ranges):
+    """色 → 距離の 3 次元 LUT (256^3 個の uint8 = 16 MB を 1 次元にしたもの、並びは _bgr_index の順)
+
+    値は target_rgb からの距離で、key_ranges の範囲に入る色は 0 (どの許容値でも透過する)。
+    範囲がいくつあっても、画素ごとの処理はこの表を 1 回引くだけになる。
+    """
+    dr, dg, db = (_abs_diff_lut(v) for v in target_rgb)
+    lut = np.maximum(np.maximum(db[:, None, None], dg[None, :, None]), dr[None, None, :])
+    for lo, hi in key_ranges:
+        lut[lo[2]:hi[2] + 1, lo[1]:hi[1] + 1, lo[0]:hi[0] + 1] = 0
+    return lut.reshape(-1)
+
+
+def _bgr_index(rgba):
+    # (B << 16) | (G << 8) | R per pixel. On little endian that is the low
+    # 24 bits of the pixel read as one uint32, so no per-channel work is needed
+    if sys.byteorder == "little" and rgba.shape[-1] == 4 and rgba.flags.c_contiguous:
+        return rgba.view(np.uint32)[..., 0] & np.uint32(0xFFFFFF)
+    index = rgba[..., 2].astype(np.uint32) << 16
+    index |= rgba[..., 1].astype(np.uint32) << 8
+    index |= rgba[..., 0]
+    return index
+
+
+def distance_map(rgba, target_rgb, key_ranges=()):
+    """各画素の target_rgb からの距離（RGB 各チャンネル差の最大値, uint8 の H×W 配列）を返す
+
+    key_ranges (color_range と同じ形の範囲のタプル) に入る画素は距離 0 にする。
+    """
+    if key_ranges:
+        key_ranges = tuple((tuple(lo), tuple(hi)) for lo, hi in key_ranges)
+        return rgb_distance_lut(tuple(target_rgb), key_ranges).take(_bgr_index(rgba))
+    dist = _abs_diff_lut(target_rgb[0])[rgba[..., 0]]
+    np.maximum(dist, _abs_diff_lut(target_rgb[1])[rgba[..., 1]], out=dist)
+    np.maximum(dist, _abs_diff_lut(target_rgb[2])[rgba[..., 2]], out=dist)
+    return dist
+
+
+def mask_runs(mask, row_offset=0):
+    """2 値画像 (H×W, bool) の True の横方向の連なり (run) を (行, 開始列, 終了列) の配列で返す
+
+    終了列はその run の次の列。run は行・列の順に並ぶ。
+    """
+    height, width = mask.shape
+    # 各行の右に False の列を足して 1 次元にすると、行をまたいで run がつながらない。
+    # 先頭にも False を 1 つ置けば、値が変わる位置が run の開始と終了を交互に指す
+    padded = np.zeros(height * (width + 1) + 1, dtype=bool)
+    padded[1:].reshape(height, width + 1)[:, :width] = mask
+    changes = np.flatnonzero(padded[1:] != padded[:-1])
+    starts, ends = changes[0::2], changes[1::2]
+    rows = starts // (width + 1)
+    return rows + row_offset, starts - rows * (width + 1), ends - rows * (width + 1)
+
+
+def _run_components(rows, starts, ends):
+    """上下に重なる run を同じ領域として (4 近傍) まとめ、run ごとの領域番号を返す
+
+    隣り合う行の run の対応は二分探索で求め、領域の統合は配列上の union-find
+    (小さい番号へのつなぎ替え + 経路の短縮) で行う。どちらも run 数にほぼ比例する。
+    """
+    count = len(rows)
+    labels = np.arange(count, dtype=np.int32)
+    if count == 0:
+        return labels
+    stride = int(ends.max()) + 1
+    start_keys = rows * stride + starts
+    end_keys = rows * stride + ends
+    # run i と重なる 1 行上の run は [lo, hi) の範囲に並んでいる
+    above = (rows - 1) * stride
+    lo = np.searchsorted(end_keys, above + starts, side="right")
+    hi = np.searchsorted(start_keys, above + ends, side="left")
+    counts = np.maximum(hi - lo, 0)
+    src = np.repeat(np.arange(count), counts)
+    offsets = np.arange(len(src)) - np.repeat(np.cumsum(counts) - counts, counts)
+    dst = np.repeat(lo, counts) + offsets
+
+    while len(src):
+        label_src = labels[src]
+        label_dst = labels[dst]
+        linked = label_src != label_dst
+        if not linked.any():
+            break
+        src, dst = src[linked], dst[linked]
+        label_src, label_dst = label_src[linked], label_dst[linked]
+        # 領域の代表同士を小さい番号の側へつなぎ、代表までの経路を短縮する
+        np.minimum.at(labels, np.maximum(label_src, label_dst), np.minimum(label_src, label_dst))
+        while True:
+            parents = labels[labels]
+            if np.array_equal(parents, labels):
+                break
+            labels = parents
+    return labels
+
+
+def border_connected_runs(rows, starts, ends, height, width):
+    """画像の外周につながっている run かどうかを run ごとに返す"""
+    labels = _run_components(rows, starts, ends)
+    on_border = (rows == 0) | (rows == height - 1) | (starts == 0) | (ends == width)
+    connected = np.zeros(len(labels), dtype=bool)
+    connected[labels[on_border]] = True
+    return connected[labels]
+
+
+def runs_to_mask(rows, starts, ends, height, width, row_offset=0):
+    """run を row_offset 行目からの H×W の 2 値画像 (uint8, 0/1) に描く"""
+    marks = np.zeros(height * (width + 1) + 1, dtype=np.int8)
+    base = (rows - row_offset) * (width + 1)
+    marks[base + starts] = 1
+    marks[base + ends] = -1
+    return np.cumsum(marks[:-1], dtype=np.int8).view(np.uint8).reshape(height, width + 1)[:, :width]
+
+
+def border_connected(mask):
+    """mask (H×W, bool) の True の画素のうち、画像の外周から True だけをたどって届くものを返す"""
+    height, width = mask.shape
+    rows, starts, ends = mask_runs(mask)
+    connected = border_connected_runs(rows, starts, ends, height, width)
+    return runs_to_mask(rows[connected], starts[connected], ends[connected], height, width).view(bool)
+
+
+def key_color(rgba, target_rgb, tolerance, border_only=False, key_ranges=()):
+    """RGBA 配列 (H×W×4, uint8) のうち target_rgb から tolerance 以内の画素の α を 0 にする（配列を直接書き換える）
+
+    border_only=True なら、そのうち画像の外周からつながっている背景だけを透過する
+    （錠剤の中の白い刻印やハイライトは残る）。key_ranges の範囲に入る画素も背景として扱う。
+    """
+    background = distance_map(rgba, target_rgb, key_ranges) <= tolerance
+    if border_only:
+        background = border_connected(background)
+    rgba[..., 3][background] = 0
+    return rgba
+
+
+def tolerance_lut(tolerance):
+    """距離 → α 上限の LUT（tolerance 以内なら 0、それ以外は 255）"""
+    return np.where(np.arange(256) <= tolerance, 0, 255).astype(np.uint8)
+
+
+def apply_tolerance(rgba, dist, tolerance, border_only=False):
+    """事前計算した距離マップから透過済みの RGBA 配列を新しく作る（rgba は変更しない）"""
+    keyed = rgba.copy()
+    if border_only:
+        keyed[..., 3][border_connected(dist <= tolerance)] = 0
+    else:
+        np.minimum(rgba[..., 3], tolerance_lut(tolerance)[dist], out=keyed[..., 3])
+    return keyed
+
+
+def apply_tolerance_argb32(rgba, dist, tolerance, opaque=False, border_only=False):
+    """apply_tolerance と同じ透過処理を、QImage.Format_ARGB32_Premultiplied の並びで新しい配列に書き出す
+
+    この形式なら QPixmap.fromImage が変換もコピーもせずに済む。
+    opaque=True (元画像に半透明の画素が無い) なら α は 0 か 255 だけなので乗算を省ける。
+    """
+    # 1 画素 = 32bit 値として並べ替え、透過する画素は丸ごと 0 にする
+    pixels = np.ascontiguousarray(rgba).view(np.uint32)[..., 0]
+    if sys.byteorder == "little":
+        # 0xAABBGGRR -> 0xAARRGGBB
+        out = pixels & 0xFF00FF00
+        tmp = pixels << 16
+        tmp &= 0x00FF0000
+        out |= tmp
+        np.right_shift(pixels, 16, out=tmp)
+        tmp &= 0x000000FF
+        out |= tmp
+    else:
+        # 0xRRGGBBAA -> 0xAARRGGBB
+        out = pixels >> 8
+        out |= pixels << 24
+    if border_only:
+        # 0/1 の背景マスクから 1 を引くと、残す画素が 0xFFFFFFFF、透過する画素が 0 になる
+        keep = border_connected(dist <= tolerance).view(np.uint8).astype(np.uint32)
+        keep -= 1
+        out &= keep
+    else:
+        keep = np.where(np.arange(256) <= tolerance, 0, 0xFFFFFFFF).astype(np.uint32)
+        out &= keep[dist]
+
+    argb = out.view(np.uint8).reshape(rgba.shape)
+    if not opaque:
+        alpha = argb[..., ARGB32_ORDER.index(3)]
+        for i, channel in enumerate(ARGB32_ORDER):
+            if channel != 3:
+                argb[..., i] = PREMULTIPLY_LUT[alpha, argb[..., i]]
+    return argb
+
+
+def key_image(img, target_rgb, tolerance, border_only=False, key_ranges=()):
+    """PIL 画像を透過処理した新しい RGBA 画像を返す"""
+    if img.mode != "RGBA":
+        img = img.convert("RGBA")
+    rgba = np.array(img)
+    key_color(rgba, target_rgb, tolerance, border_only, key_ranges)
+    return Image.fromarray(rgba)
+
+
+def corner_color(rgba):
+    """四隅の平均色を背景色として返す"""
+    corners = rgba[[0, 0, -1, -1], [0, -1, 0, -1], :3].astype(np.int32)
+    return tuple(int(v) for v in corners.sum(axis=0) // 4)
@@ -0,0 +1,61 @@
+import threading
+from collections import OrderedDict
+
+
+class BoundedLRU:
+    """合計バイト数に上限を持つ LRU キャッシュ（スレッドセーフ）"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._items = OrderedDict()  # key -> (value, nbytes)
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return None
+            self._items.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, nbytes=None):
+        if nbytes is None:
+            nbytes = value.nbytes
+        with self._lock:
+            self._discard(key)
+            if nbytes > self.max_bytes:
+                return  # 上限を超えるものはキャッシュしない
+            self._items[key] = (value, nbytes)
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes:
+                _key, (_value, old_nbytes) = self._items.popitem(last=False)
+                self.total_bytes -= old_nbytes
+
+    def discard(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def discard_where(self, predicate):
+        """predicate(key) が真になるエントリをすべて捨てる"""
+        with self._lock:
+            for key in [key for key in self._items if predicate(key)]:
+                self._discard(key)
+
+    def _discard(self, key):
+        entry = self._items.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.total_bytes = 0
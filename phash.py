@@ -0,0 +1,129 @@
+"""透過・クロップ後の画像の知覚ハッシュと、その近傍検索
+
+ハッシュは透過処理して不透明な範囲に切り抜いた画像 (透過部分は黒) を 9x8 の
+グレースケールに縮め、横に隣り合う画素の明暗を並べた 64bit 値 (差分ハッシュ)。
+似た画像ほどハッシュのハミング距離が小さい。
+"""
+import numpy as np
+from PIL import Image
+
+from keying import key_color
+from streaming import corner_color_of
+
+HASH_SIZE = 8
+# ハッシュ用にデコードする大きさの目安 (JPEG はこれ以上の範囲で縮小してデコードする)
+DECODE_SIZE = (256, 256)
+
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def keyed_phash(img, target_rgb, tolerance, border_only=False, key_ranges=()):
+    """PIL 画像を透過処理・クロップした結果の知覚ハッシュ (0 〜 2**64 - 1 の int)"""
+    rgba = np.array(img.convert("RGBA"))
+    key_color(rgba, target_rgb, tolerance, border_only, key_ranges)
+    rows = np.flatnonzero(rgba[..., 3].any(axis=1))
+    cols = np.flatnonzero(rgba[..., 3].any(axis=0))
+    if rows.size:
+        rgba = rgba[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    # 透過部分を黒にしたグレースケール (α を乗算)
+    gray = rgba[..., :3].astype(np.float32) @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    gray *= rgba[..., 3] / 255
+    # 錠剤はほぼ対称なので DCT (pHash) だと奇数次の成分が 0 付近に集まってビットが安定しない。
+    # 隣り合う画素の差なら輪郭・刻印・割線の向きがそのまま残る
+    small = np.asarray(Image.fromarray(gray, "F").resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BOX))
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def open_for_hash(fp):
+    """ハッシュ計算用に画像を開く (JPEG は DECODE_SIZE 以上を保つ範囲で縮小してデコード)"""
+    img = Image.open(fp)
+    img.draft(None, DECODE_SIZE)
+    img.load()
+    return img
+
+
+def file_phash(path, target_rgb, tolerance, border_only=False, key_ranges=()):
+    with open_for_hash(path) as img:
+        return keyed_phash(img, target_rgb, tolerance, border_only, key_ranges)
+
+
+def corner_phash(path, tolerance, border_only=False):
+    """四隅の平均色を背景色として透過したときの (背景色, 知覚ハッシュ)"""
+    with open_for_hash(path) as img:
+        target_rgb = corner_color_of(img)
+        return target_rgb, keyed_phash(img, target_rgb, tolerance, border_only)
+
+
+def to_db(phash):
+    """SQLite の INTEGER (符号付き 64bit) に入る値にする"""
+    return phash - (1 << 64) if phash >= 1 << 63 else phash
+
+
+def hamming(a, b):
+    """uint64 配列同士 (またはその一方がスカラー) のハミング距離"""
+    diff = np.bitwise_xor(a, b)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(diff)
+    return _POPCOUNT8[np.ascontiguousarray(diff).view(np.uint8)].reshape(diff.shape + (8,)).sum(axis=-1)
+
+
+class PhashIndex:
+    """画像 ID と知覚ハッシュの配列。全件とのハミング距離を一度に求めて近いものを返す"""
+
+    def __init__(self, ids, hashes):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        # DB には符号付きで入っているのでビット列として読み直す
+        self.hashes = np.asarray(hashes, dtype=np.int64).view(np.uint64)
+
+    @classmethod
+    def from_db(cls, db):
+        rows = np.array(db.image_phashes(), dtype=np.int64).reshape(-1, 2)
+        return cls(rows[:, 0], rows[:, 1])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def nearest(self, phash, k=10, max_distance=None, exclude_ids=()):
+        """phash (符号付きの DB の値でもよい) に近い順に最大 k 件の (画像 ID, 距離)"""
+        if not len(self.ids):
+            return []
+        distances = hamming(self.hashes, np.uint64(phash % (1 << 64)))
+        if exclude_ids:
+            distances = np.where(np.isin(self.ids, list(exclude_ids)), 255, distances)
+        k = min(k, len(distances))
+        candidates = np.argpartition(distances, k - 1)[:k]
+        candidates = candidates[np.argsort(distances[candidates], kind="stable")]
+        return [
+            (int(self.ids[i]), int(distances[i])) for i in candidates
+            if distances[i] != 255 and (max_distance is None or distances[i] <= max_distance)
+        ]
+
+    def near_duplicates(self, max_distance):
+        """距離が max_distance 以下の組 (画像 ID, 画像 ID, 距離) を距離の近い順に返す
+
+        64bit を max_distance + 1 個の区間に分けると、距離が max_distance 以下の 2 つの
+        ハッシュはどこかの区間が必ず一致する。区間ごとに値でまとめた組だけを調べる。
+        """
+        firsts, seconds = [], []
+        bounds = np.linspace(0, 64, min(max_distance, 63) + 2).astype(int)
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            keys = (self.hashes >> np.uint64(lo)) & np.uint64((1 << (hi - lo)) - 1)
+            order = np.argsort(keys, kind="stable")
+            sorted_keys = keys[order]
+            # 並べ替えた後で step 個先と区間の値が同じなら同じ組に入る
+            for step in range(1, len(order)):
+                same = np.flatnonzero(sorted_keys[step:] == sorted_keys[:-step])
+                if not same.size:
+                    break
+                first, second = order[same], order[same + step]
+                near = hamming(self.hashes[first], self.hashes[second]) <= max_distance
+                firsts.append(first[near])
+                seconds.append(second[near])
+        if not firsts:
+            return []
+        first, second = np.concatenate(firsts), np.concatenate(seconds)
+        a, b = self.ids[first], self.ids[second]
+        distances = hamming(self.hashes[first], self.hashes[second]).astype(np.int64)
+        pairs = np.unique(np.stack([np.minimum(a, b), np.maximum(a, b), distances], axis=1).reshape(-1, 3), axis=0)
+        return sorted(((int(a), int(b), int(d)) for a, b, d in pairs), key=lambda p: (p[2], p[0], p[1]))
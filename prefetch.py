@@ -0,0 +1,72 @@
+from PyQt6.QtCore import QRunnable
+
+
+def neighbor_indices(index, count, window):
+    """index の前後 window 枚を近い順に返す（端は反対側へ回り込む）"""
+    indices = []
+    for step in range(1, window + 1):
+        for i in ((index + step) % count, (index - step) % count):
+            if i != index and i not in indices:
+                indices.append(i)
+    return indices
+
+
+class PrefetchJob(QRunnable):
+    def __init__(self, prefetcher, generation, entries, preview_size=None):
+        super().__init__()
+        self.prefetcher = prefetcher
+        self.generation = generation
+        self.entries = entries
+        self.preview_size = preview_size
+
+    def run(self):
+        used_bytes = 0
+        for path, target_rgb, tolerance, border_only, key_ranges in self.entries:
+            if self.generation != self.prefetcher.generation:
+                return  # 表示位置が変わったので古い先読みは打ち切る
+            try:
+                result = self.prefetcher.pipeline.render(
+                    path, target_rgb, tolerance, remember=True, use_store=True, preview_size=self.preview_size,
+                    border_only=border_only, key_ranges=key_ranges)
+            except Exception:
+                continue  # 読めないファイルは表示時にエラーを出す
+            try:
+                self.prefetcher.pipeline.store(path, target_rgb, tolerance, result, border_only, key_ranges)
+            except Exception:
+                pass
+            qimg, buffer, _factor = result
+            if buffer is None:
+                used_bytes += qimg.sizeInBytes()  # ディスクキャッシュから読んだ分だけ
+            else:
+                # デコード済み配列 (4B/px) + 距離マップ (1B/px) + 透過済み画像 (4B/px)
+                used_bytes += buffer.nbytes * 9 // 4
+            if used_bytes >= self.prefetcher.max_bytes:
+                return
+
+
+class NeighborPrefetcher:
+    """表示中の画像の前後をバックグラウンドでデコード・透過処理しておく"""
+
+    def __init__(self, pipeline, pool, window, max_bytes):
+        self.pipeline = pipeline
+        self.pool = pool
+        self.window = window
+        self.max_bytes = max_bytes
+        self.generation = 0
+
+    def update(self, images_data, index, preview_size=None):
+        """images_data は loaded_images_data と同じ
+        (id, drug_name, image_path, target_rgb, tolerance, border_only, key_ranges) のリスト。
+        preview_size は表示時と同じ縮小プレビューで先読みするための表示サイズ (幅, 高さ)"""
+        self.generation += 1
+        if self.window <= 0 or not 0 <= index < len(images_data):
+            return
+        entries = []
+        for i in neighbor_indices(index, len(images_data), self.window):
+            _id, _drug_name, image_path, target_rgb, tolerance, border_only, key_ranges = images_data[i]
+            entries.append((image_path, target_rgb, tolerance, border_only, key_ranges))
+        if entries:
+            self.pool.start(PrefetchJob(self, self.generation, entries, preview_size), -1)
+
+    def cancel(self):
+        self.generation += 1
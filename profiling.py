@@ -0,0 +1,109 @@
+"""処理段階ごとの所要時間の計測
+
+SEATHR_PROFILE=1 (または seathr.py --profile) で有効になる。各段階の直近の計測値から
+パーセンタイルを求め、一定回数ごとにログへ出し、終了時にまとめを出力する。
+無効のときの stage() はほぼ何もしない。
+"""
+import atexit
+import logging
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+import config
+
+logger = logging.getLogger("seathr.profile")
+
+
+def _percentile(sorted_values, q):
+    index = min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class StageProfiler:
+    def __init__(self, enabled=False, window=200, log_every=50):
+        self.enabled = enabled
+        self.window = window
+        self.log_every = log_every
+        self._samples = {}  # 段階名 -> 直近の所要時間 (秒)
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._null = nullcontext()
+
+    def stage(self, name):
+        if not self.enabled:
+            return self._null
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        with self._lock:
+            samples = self._samples.get(name)
+            if samples is None:
+                samples = self._samples[name] = deque(maxlen=self.window)
+            samples.append(seconds)
+            count = self._counts[name] = self._counts.get(name, 0) + 1
+        if count % self.log_every == 0:
+            logger.info(self.format_stage(name))
+
+    def stats(self, name):
+        """(回数, p50, p90, p99) をミリ秒で返す。記録が無ければ None"""
+        with self._lock:
+            samples = sorted(self._samples.get(name, ()))
+            count = self._counts.get(name, 0)
+        if not samples:
+            return None
+        return (count,) + tuple(_percentile(samples, q) * 1000 for q in (50, 90, 99))
+
+    def stage_names(self):
+        with self._lock:
+            return list(self._samples)
+
+    def format_stage(self, name):
+        count, p50, p90, p99 = self.stats(name)
+        return f"{name:<16} n={count:<6} p50={p50:8.2f}ms p90={p90:8.2f}ms p99={p99:8.2f}ms"
+
+    def hud_text(self):
+        """画面表示用の短いまとめ (段階ごとに p50/p90)"""
+        lines = []
+        for name in self.stage_names():
+            _count, p50, p90, _p99 = self.stats(name)
+            lines.append(f"{name} {p50:.1f}/{p90:.1f}ms")
+        return "\n".join(lines)
+
+    def report(self):
+        lines = ["seathr profile (last %d samples per stage)" % self.window]
+        lines.extend(self.format_stage(name) for name in self.stage_names())
+        return "\n".join(lines)
+
+    def dump(self, path=None):
+        if not self.stage_names():
+            return
+        text = self.report()
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+        else:
+            print(text, file=sys.stderr)
+
+    def enable(self):
+        if not self.enabled:
+            self.enabled = True
+            if not logger.handlers:
+                logger.addHandler(logging.StreamHandler())
+                logger.setLevel(logging.INFO)
+            atexit.register(self.dump, config.PROFILE_REPORT or None)
+
+
+profiler = StageProfiler()
+if config.PROFILE:
+    profiler.enable()
@@ -0,0 +1,217 @@
+from collections import namedtuple
+import os
+
+from PyQt6.QtCore import QObject, QRunnable, Qt, pyqtSignal
+from PyQt6.QtGui import QImage
+
+from image_cache import DecodedImageCache, DistanceMapCache, file_key, proxy_factor
+from lru import BoundedLRU
+from keying import apply_tolerance_argb32
+from phash import file_phash
+from profiling import profiler
+
+# image: 透過済みの QImage, scaled: 表示サイズに縮小した QImage, buffer: image が参照する配列
+# (image やそこから作った QPixmap を使う間は保持しておくこと),
+# factor: image の縮小率 (1 なら原寸)
+RenderResult = namedtuple("RenderResult", ["image", "scaled", "buffer", "factor"])
+
+
+class ImagePipeline:
+    """デコード → 透過処理 → QImage 生成までの処理（ワーカースレッドから呼ばれる）"""
+
+    def __init__(self, decode_budget, distance_budget, result_budget=0, keyed_store=None,
+                 streaming_min_pixels=None):
+        self.decoded_cache = DecodedImageCache(decode_budget)
+        self.distance_cache = DistanceMapCache(distance_budget)
+        # 先読みした透過済み画像 (QImage, data, factor)
+        self.result_cache = BoundedLRU(result_budget)
+        self.keyed_store = keyed_store
+        # これ以上の画素数の画像は原寸の配列を作らず帯ごとに処理して保存する
+        self.streaming_min_pixels = streaming_min_pixels
+
+    def render(self, path, target_rgb, tolerance, remember=False, use_store=False, preview_size=None,
+               border_only=False, key_ranges=()):
+        """透過済みの (QImage, buffer, factor) を返す。
+
+        QImage は Format_ARGB32_Premultiplied で buffer (numpy 配列) をコピーせずに参照する。
+        remember=True なら結果をメモリに残す。use_store=True ならディスクの透過済み
+        キャッシュがあればそれを読み込む（その場合 buffer は None）。
+        preview_size (幅, 高さ) を渡すと、その表示に足りる範囲で縮小した画像で処理する
+        （ディスクのキャッシュも同じ縮小率のものを使う）。
+        border_only=True なら画像の外周からつながる背景だけを透過する。
+        key_ranges の範囲に入る色は許容値にかかわらず背景として透過する。
+        """
+        key = file_key(path)
+        factor = 1
+        if preview_size is not None:
+            factor = proxy_factor(self.decoded_cache.image_size(path, key), preview_size)
+        result_key = (key, tuple(target_rgb), tolerance, border_only, tuple(key_ranges), factor)
+        cached = self.result_cache.get(result_key)
+        if cached is not None:
+            return cached
+
+        # Entries are stored per proxy factor, so a preview loads a
+        # display-sized file rather than a full-size one
+        if use_store and self.keyed_store:
+            stored_path = self.keyed_store.lookup(path, key, target_rgb, tolerance, border_only, key_ranges, factor)
+            with profiler.stage("store_load"):
+                stored = QImage(stored_path) if stored_path else QImage()
+                if not stored.isNull():
+                    stored = stored.convertToFormat(QImage.Format.Format_ARGB32_Premultiplied)
+            if not stored.isNull():
+                result = (stored, None, factor)
+                if remember:
+                    self.result_cache.put(result_key, result, stored.sizeInBytes())
+                return result
+
+        rgba = self.decoded_cache.get(path, key, factor)
+        # The distance map only depends on the image and key colors, so a
+        # tolerance change is a single LUT pass over it
+        dist = self.distance_cache.get((key, factor), rgba, target_rgb, key_ranges)
+        with profiler.stage("keying"):
+            keyed = apply_tolerance_argb32(
+                rgba, dist, tolerance, self.decoded_cache.is_opaque(key, factor), border_only)
+        height, width = keyed.shape[:2]
+        # Wrap the keyed array directly (stride = width * 4); QPixmap.fromImage
+        # can then share it without a format conversion
+        qimg = QImage(keyed.data, width, height, width * 4, QImage.Format.Format_ARGB32_Premultiplied)
+        result = (qimg, keyed, factor)
+        if remember:
+            self.result_cache.put(result_key, result, keyed.nbytes)
+        return result
+
+    def forget(self, path):
+        """path の画像のデコード結果・距離マップ・透過済み画像をメモリから捨てる"""
+        self.decoded_cache.forget(path)
+        self.distance_cache.forget(path)
+        path = os.path.abspath(path)
+        self.result_cache.discard_where(lambda result_key: result_key[0][0] == path)
+
+    def store(self, path, target_rgb, tolerance, result, border_only=False, key_ranges=()):
+        """render() の結果をディスクの透過済みキャッシュに縮小率ごとに書き込む（キャッシュから読んだ結果は除く）"""
+        qimg, buffer, factor = result
+        if self.keyed_store and buffer is not None:
+            rgba = qimg.convertToFormat(QImage.Format.Format_RGBA8888)
+            data = rgba.constBits().asstring(rgba.sizeInBytes())
+            self.keyed_store.put(
+                path, file_key(path), target_rgb, tolerance, data, rgba.width(), rgba.height(), border_only,
+                key_ranges, factor)
+
+
+    def store_streaming(self, path, target_rgb, tolerance, border_only=False, key_ranges=()):
+        """巨大な画像なら帯ごとの処理でディスクキャッシュに書き込んで True を返す"""
+        if (not self.keyed_store or self.keyed_store.image_format != "png"
+                or self.streaming_min_pixels is None):
+            return False
+        key = file_key(path)
+        width, height = self.decoded_cache.image_size(path, key)
+        if width * height < self.streaming_min_pixels:
+            return False
+        self.keyed_store.put_streaming(path, key, target_rgb, tolerance, border_only, key_ranges)
+        return True
+
+
+class RenderSignals(QObject):
+    finished = pyqtSignal(int, object)  # generation, RenderResult
+    failed = pyqtSignal(int, str, object)  # generation, path, exception
+
+
+class RenderJob(QRunnable):
+    """1 回分の再描画処理。新しい世代の要求が出ていれば途中で破棄する"""
+
+    def __init__(self, pipeline, signals, generation, is_current, path, target_rgb, tolerance, display_size,
+                 use_store=False, preview=False, border_only=False, key_ranges=()):
+        super().__init__()
+        self.pipeline = pipeline
+        self.signals = signals
+        self.generation = generation
+        self.is_current = is_current
+        self.path = path
+        self.target_rgb = target_rgb
+        self.tolerance = tolerance
+        self.display_size = display_size
+        self.use_store = use_store
+        self.preview = preview
+        self.border_only = border_only
+        self.key_ranges = key_ranges
+
+    def run(self):
+        if not self.is_current(self.generation):
+            return
+        try:
+            preview_size = (self.display_size.width(), self.display_size.height()) if self.preview else None
+            qimg, buffer, factor = self.pipeline.render(
+                self.path, self.target_rgb, self.tolerance, use_store=self.use_store, preview_size=preview_size,
+                border_only=self.border_only, key_ranges=self.key_ranges)
+            if not self.is_current(self.generation):
+                return
+            with profiler.stage("scale_worker"):
+                scaled = qimg.scaled(
+                    self.display_size, Qt.AspectRatioMode.KeepAspectRatio,
+                    Qt.TransformationMode.SmoothTransformation)
+        except Exception as e:
+            self.signals.failed.emit(self.generation, self.path, e)
+            return
+        if self.is_current(self.generation):
+            self.signals.finished.emit(self.generation, RenderResult(qimg, scaled, buffer, factor))
+        if self.use_store:
+            try:
+                self.pipeline.store(
+                    self.path, self.target_rgb, self.tolerance, (qimg, buffer, factor), self.border_only,
+                    self.key_ranges)
+            except Exception:
+                pass  # キャッシュに書けなくても表示には影響しない
+
+
+class StoreJob(QRunnable):
+    """透過済み画像をディスクキャッシュに書き込むだけのジョブ
+
+    preview_size を渡すと、表示と同じ縮小率で書き込む (原寸は書かない)。
+    """
+
+    def __init__(self, pipeline, path, target_rgb, tolerance, border_only=False, key_ranges=(), preview_size=None):
+        super().__init__()
+        self.pipeline = pipeline
+        self.path = path
+        self.target_rgb = target_rgb
+        self.tolerance = tolerance
+        self.border_only = border_only
+        self.key_ranges = key_ranges
+        self.preview_size = preview_size
+
+    def run(self):
+        try:
+            if self.preview_size is None and self.pipeline.store_streaming(
+                    self.path, self.target_rgb, self.tolerance, self.border_only, self.key_ranges):
+                return
+            result = self.pipeline.render(
+                self.path, self.target_rgb, self.tolerance, use_store=True, preview_size=self.preview_size,
+                border_only=self.border_only, key_ranges=self.key_ranges)
+            self.pipeline.store(self.path, self.target_rgb, self.tolerance, result, self.border_only, self.key_ranges)
+        except Exception:
+            pass
+
+
+class PhashSignals(QObject):
+    finished = pyqtSignal(object, object)  # request, phash (None if the image couldn't be read)
+
+
+class PhashJob(QRunnable):
+    """知覚ハッシュを計算するだけのジョブ（GUI スレッドで画像をデコードしない）"""
+
+    def __init__(self, signals, request, path, target_rgb, tolerance, border_only=False, key_ranges=()):
+        super().__init__()
+        self.signals = signals
+        self.request = request
+        self.path = path
+        self.target_rgb = target_rgb
+        self.tolerance = tolerance
+        self.border_only = border_only
+        self.key_ranges = key_ranges
+
+    def run(self):
+        try:
+            phash = file_phash(self.path, self.target_rgb, self.tolerance, self.border_only, self.key_ranges)
+        except Exception:
+            phash = None
+        self.signals.finished.emit(self.request, phash)
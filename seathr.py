@@ -1,17 +1,25 @@
+import time
+_START = time.perf_counter() # Reference point for --startup-time
+
 from PyQt6.QtWidgets import (
     QApplication, QLabel, QFileDialog, QWidget, QColorDialog,
-    QMenu, QSlider, QInputDialog, QMessageBox, QVBoxLayout,
-    QListWidget, QListWidgetItem, QPushButton, QDialog, QHBoxLayout, QLineEdit
+    QMenu, QSlider, QInputDialog, QMessageBox, QPushButton, QDialog
 )
 from PyQt6.QtGui import QPixmap, QImage, QMouseEvent, QPainter, QPen, QColor, QIcon
-from PyQt6.QtCore import Qt, QPoint, QSize
-from PIL import Image
+from PyQt6.QtCore import Qt, QPoint, QSize, QThreadPool, QTimer
+# numpy/Pillow (render_pipeline, prefetch, keyed_store) and the database are
+# only loaded when first needed so the window can paint before them
+from lru import BoundedLRU
+from drug_picker import DrugPickerDialog
+from profiling import profiler
+import config
+import argparse
 import sys
 import sqlite3
 import os
 
 class TransparentImageViewer(QWidget):
-    def __init__(self):
+    def __init__(self, db_name="drugs.db", measure_startup=False):
         super().__init__()
         self.setWindowFlags(
             Qt.WindowType.FramelessWindowHint |
@@ -57,22 +65,76 @@ class TransparentImageViewer(QWidget):
         self.image_counter_label.setStyleSheet("color: white; background-color: rgba(0, 0, 0, 80%);")
         self.image_counter_label.setGeometry(90, 40, 80, 20)
 
+        # Per-stage timings next to the counter when profiling is on
+        self.profile_label = None
+        if profiler.enabled:
+            self.profile_label = QLabel("", self)
+            self.profile_label.setStyleSheet(
+                "color: white; background-color: rgba(0, 0, 0, 80%); font-family: monospace; font-size: 10px;")
+            self.profile_label.move(180, 40)
+            self.profile_timer = QTimer(self)
+            self.profile_timer.timeout.connect(self.update_profile_label)
+            self.profile_timer.start(500)
+
         self.image_pixmap = None
+        self.image_buffer = None # Keyed array image_pixmap shares its pixels with
+        self.image_factor = 1 # Downscale factor of image_pixmap when it is a preview proxy
         self.drag_pos = QPoint()
         self.resizing = False
 
         self.triangle_size = 40
         self.tolerance = 10
         self.target_rgb = (255, 255, 255)
+        self.border_only = bool(config.BORDER_ONLY) # Only clear background connected to the image border
+        self.key_ranges = () # Extra ((r, g, b) min, (r, g, b) max) colour boxes keyed with target_rgb
         self.current_image_path = None
 
-        self.db_name = "drugs.db"
-        self._init_db()
-
-        self.loaded_images_data = []  # Stores (id, drug_name, image_path, target_rgb, tolerance) for currently loaded drug
+        # Decode/keying runs on a worker thread; each request gets a generation
+        # number and results from superseded requests are dropped.
+        # The pipeline itself is created by _ensure_pipeline on first use
+        self.render_pool = QThreadPool(self)
+        self.render_generation = 0
+        self.pipeline = None
+        self.render_signals = None
+        self.phash_signals = None
+        self.prefetcher = None
+
+        # Debounce slider drags (and proxy upgrades on resize) so only the
+        # settled state gets rendered
+        self.render_timer = QTimer(self)
+        self.render_timer.setSingleShot(True)
+        self.render_timer.setInterval(config.SLIDER_DEBOUNCE_MS)
+        self.render_timer.timeout.connect(self._request_render)
+
+        # Scaled pixmaps per (pixmap, target size) so repeated sizes and
+        # re-shows after minimize don't rescale again
+        self.scaled_cache = BoundedLRU(config.SCALED_CACHE_MB * 1024 * 1024)
+        # Coalesces bursts of resize events into one redraw per event-loop pass
+        self.display_timer = QTimer(self)
+        self.display_timer.setSingleShot(True)
+        self.display_timer.setInterval(0)
+        self.display_timer.timeout.connect(self.update_display)
+
+        self.db_name = db_name
+        self._db = None # Opened by the db property on first use
+        self._phash_index = None # Loaded on the first similar-image search, dropped when images change
+        self.similar_generation = 0 # Only the latest similar-image search opens its dialog
+        self.catalog_monitor = None # Tracks which catalog files exist; started once the database is open
+
+        self.loaded_images_data = []  # Stores (id, drug_name, image_path, target_rgb, tolerance, border_only, key_ranges) for currently loaded drug
         self.current_image_index = -1
-
-        self.load_image_dialog() # Initial image load or database load
+        # Open bundle.DrugBundle while viewing a bundle; loaded_images_data then
+        # holds its entries (id None) and the pixels come straight from its mmap
+        self.bundle = None
+
+        # Startup timing: report the first frame (and first image) and, with
+        # measure_startup, quit right after so the run can be scripted
+        self.measure_startup = measure_startup
+        self.startup_wait_for_image = False
+        self.first_frame_done = False
+        self.first_image_done = False
+        # (image_path, drug_name) to open once the first frame is up; None = nothing requested
+        self.initial_open = None
 
     def create_header_controls(self):
         # Minimize button
@@ -97,22 +159,115 @@ class TransparentImageViewer(QWidget):
         self.minimize_button.raise_()
         self.close_button.raise_()
 
+    @property
+    def db(self):
+        if self._db is None:
+            self._init_db()
+        return self._db
+
     def _init_db(self):
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS images (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                drug_name TEXT NOT NULL,
-                image_path TEXT NOT NULL,
-                target_rgb_r INTEGER,
-                target_rgb_g INTEGER,
-                target_rgb_b INTEGER,
-                tolerance INTEGER
-            )
-        ''')
-        conn.commit()
-        conn.close()
+        from db import CatalogDB
+        self._db = CatalogDB(self.db_name)
+        QTimer.singleShot(0, self._start_catalog_monitor)
+
+    def _start_catalog_monitor(self):
+        # Check every catalog file in the background and keep watching them,
+        # so navigation can tell a missing file without touching the disk
+        if self._db is None or self.catalog_monitor is not None:
+            return
+        from integrity import CatalogMonitor
+        self.catalog_monitor = CatalogMonitor(self._db, self)
+        self.catalog_monitor.changed.connect(self._on_catalog_files_changed)
+        self.catalog_monitor.start()
+        self.catalog_monitor.watch_files(entry[2] for entry in self.loaded_images_data)
+
+    def _on_catalog_files_changed(self, rows):
+        current_modified = False
+        for path, mtime_ns in rows:
+            if self.pipeline:
+                self.pipeline.forget(path)
+            if path == self.current_image_path and mtime_ns is not None:
+                current_modified = True
+        if current_modified:
+            self._request_render(use_store=bool(self.loaded_images_data))
+
+    def _ensure_pipeline(self):
+        if self.pipeline is not None:
+            return self.pipeline
+        from render_pipeline import ImagePipeline, PhashSignals, RenderSignals
+        from prefetch import NeighborPrefetcher
+        self.pipeline = ImagePipeline(
+            config.DECODE_CACHE_MB * 1024 * 1024, config.DISTANCE_CACHE_MB * 1024 * 1024,
+            config.PREFETCH_MB * 1024 * 1024, streaming_min_pixels=config.STREAMING_MIN_PIXELS)
+        self.render_signals = RenderSignals(self)
+        self.render_signals.finished.connect(self._on_render_finished)
+        self.render_signals.failed.connect(self._on_render_failed)
+        self.phash_signals = PhashSignals(self)
+        self.phash_signals.finished.connect(self._on_phash_finished)
+        self.prefetcher = NeighborPrefetcher(
+            self.pipeline, self.render_pool, config.PREFETCH_WINDOW, config.PREFETCH_MB * 1024 * 1024)
+        if config.KEYED_CACHE:
+            from keyed_store import KeyedStore
+            # Keyed results for saved images live next to the database
+            if self._db is None:
+                self._init_db() # KeyedStore shares the database file, so make sure it is migrated
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(self.db_name)), "keyed_cache")
+            self.pipeline.keyed_store = KeyedStore(
+                self.db_name, cache_dir, config.KEYED_CACHE_FORMAT, config.KEYED_CACHE_MB * 1024 * 1024)
+        return self.pipeline
+
+    def _warm_up(self):
+        # Runs once the first frame is up: open the database and import the
+        # imaging stack while the user is still looking at the dialog
+        if self._db is None:
+            self._init_db()
+        self._ensure_pipeline()
+
+    def _report_startup(self, what):
+        elapsed = time.perf_counter() - _START
+        if self.measure_startup:
+            print(f"startup: {what} {elapsed * 1000:.0f} ms", file=sys.stderr, flush=True)
+        if profiler.enabled:
+            profiler.record(f"startup_{what.replace(' ', '_')}", elapsed)
+
+    def _startup_checkpoint(self):
+        if not self.measure_startup or not self.first_frame_done:
+            return
+        if self.first_image_done or not self.startup_wait_for_image:
+            # A Tool window doesn't count for quitOnLastWindowClosed, so quit explicitly
+            QTimer.singleShot(0, self.close)
+            QTimer.singleShot(0, QApplication.quit)
+
+    def open_initial(self, image_path=None, drug_name=None):
+        # Open what was given on the command line, else ask with the usual dialog
+        # (measure-only runs without arguments skip the dialog)
+        if drug_name:
+            self.load_drug(drug_name)
+        elif image_path:
+            self.open_file(image_path)
+        elif not self.measure_startup:
+            self.load_image_dialog()
+        if self.startup_wait_for_image and not (self.current_image_path or self.bundle):
+            self.startup_wait_for_image = False # Nothing could be opened
+            self._startup_checkpoint()
+
+    def open_file(self, file_path):
+        # Paths from the command line are relative to wherever the viewer was
+        # started; saved rows and the file watcher need them absolute
+        file_path = os.path.abspath(file_path)
+        from bundle import EXTENSION
+        if file_path.lower().endswith(EXTENSION):
+            self.open_bundle(file_path)
+            return
+        self._close_bundle()
+        self.loaded_images_data = [] # Clear previously loaded DB images
+        if self.catalog_monitor:
+            self.catalog_monitor.watch_files([])
+        self.current_image_index = -1
+        if self.prefetcher:
+            self.prefetcher.cancel()
+        self.process_and_show(file_path, self.target_rgb, self.tolerance)
+        self.update_image_counter()
 
     def load_image_dialog(self):
         choice, ok = QInputDialog.getItem(
@@ -121,12 +276,9 @@ class TransparentImageViewer(QWidget):
         )
         if ok and choice == "ファイルから読み込む":
             file_path, _ = QFileDialog.getOpenFileName(
-                self, "画像ファイルを選択", "", "画像 (*.png *.jpg *.jpeg *.bmp)")
+                self, "画像ファイルを選択", "", "画像・バンドル (*.png *.jpg *.jpeg *.bmp *.drugbundle)")
             if file_path:
-                self.loaded_images_data = [] # Clear previously loaded DB images
-                self.current_image_index = -1
-                self.process_and_show(file_path, self.target_rgb, self.tolerance)
-                self.update_image_counter()
+                self.open_file(file_path)
             else:
                 if not self.image_pixmap: # If no image was loaded at all
                     self.close()
@@ -136,49 +288,118 @@ class TransparentImageViewer(QWidget):
             if not self.image_pixmap: # If no image was loaded at all
                 self.close()
 
-    def process_and_show(self, path, target_rgb, tolerance):
+    def process_and_show(self, path, target_rgb, tolerance, use_store=False, border_only=None, key_ranges=None):
         self.current_image_path = path
         self.target_rgb = target_rgb
         self.tolerance = tolerance
+        if border_only is not None:
+            self.border_only = border_only
+        if key_ranges is not None:
+            self.key_ranges = key_ranges
+        # Don't let the programmatic update re-enter slider_changed
+        self.tolerance_slider.blockSignals(True)
         self.tolerance_slider.setValue(self.tolerance)
+        self.tolerance_slider.blockSignals(False)
         self.slider_label.setText(f"透過範囲: {self.tolerance}") # Update label when loading from DB
 
-        try:
-            img = Image.open(path).convert("RGBA")
-        except FileNotFoundError:
-            QMessageBox.critical(self, "エラー", f"画像ファイルが見つかりません: {path}")
+        self._request_render(use_store)
+
+    def _request_render(self, use_store=False):
+        self.render_timer.stop()
+        self.render_generation += 1
+        if not self.current_image_path:
             return
-        except Exception as e:
-            QMessageBox.critical(self, "エラー", f"画像の読み込み中にエラーが発生しました: {e}")
+        self.render_requested_at = time.perf_counter()
+        self._ensure_pipeline()
+        from render_pipeline import RenderJob
+        job = RenderJob(
+            self.pipeline, self.render_signals, self.render_generation, self._is_current_render,
+            self.current_image_path, self.target_rgb, self.tolerance, self.size(), use_store,
+            preview=bool(config.PREVIEW_PROXY), border_only=self.border_only, key_ranges=self.key_ranges)
+        self.render_pool.start(job)
+
+    def _is_current_render(self, generation):
+        return generation == self.render_generation
+
+    def _on_render_finished(self, generation, result):
+        if generation != self.render_generation:
             return
-
-        datas = img.getdata()
-        new_data = []
-
-        for item in datas:
-            r, g, b, a = item
-            if (
-                abs(r - self.target_rgb[0]) <= self.tolerance and
-                abs(g - self.target_rgb[1]) <= self.tolerance and
-                abs(b - self.target_rgb[2]) <= self.tolerance
-            ):
-                new_data.append((r, g, b, 0))
-            else:
-                new_data.append(item)
-
-        img.putdata(new_data)
-        qimg = QImage(img.tobytes(), img.width, img.height, QImage.Format.Format_RGBA8888)
-        self.image_pixmap = QPixmap.fromImage(qimg)
-        self.update_display()
+        # fromImage shares result.buffer instead of copying it, so keep the
+        # buffer alive for as long as the pixmap
+        self.image_buffer = result.buffer
+        with profiler.stage("from_image"):
+            self.image_pixmap = QPixmap.fromImage(result.image)
+        self.image_factor = result.factor
+        if result.scaled.size() == result.image.size().scaled(
+                self.size(), Qt.AspectRatioMode.KeepAspectRatio):
+            scaled = QPixmap.fromImage(result.scaled)
+            self.scaled_cache.put(self._scaled_cache_key(), scaled, self._pixmap_bytes(scaled))
+            self.label.setPixmap(scaled)
+            self.label.setGeometry(self.rect())
+        else:
+            self.update_display()
+        if profiler.enabled:
+            profiler.record("render_total", time.perf_counter() - self.render_requested_at)
+        if not self.first_image_done:
+            self.first_image_done = True
+            self._report_startup("first image")
+            self._startup_checkpoint()
+
+    def _on_render_failed(self, generation, path, error):
+        if generation != self.render_generation:
+            return
+        if self.measure_startup and not self.first_image_done:
+            print(f"startup: failed to open {path}: {error}", file=sys.stderr, flush=True)
+            self.startup_wait_for_image = False
+            self._startup_checkpoint()
+            return
+        if isinstance(error, FileNotFoundError) and any(entry[2] == path for entry in self.loaded_images_data):
+            # A catalog file removed since the last scan: record it and offer to delete the row
+            if self.catalog_monitor:
+                self.catalog_monitor.scan([path])
+            if 0 <= self.current_image_index < len(self.loaded_images_data):
+                self._prompt_missing_loaded_image()
+        elif isinstance(error, FileNotFoundError):
+            QMessageBox.critical(self, "エラー", f"画像ファイルが見つかりません: {path}")
+        else:
+            QMessageBox.critical(self, "エラー", f"画像の読み込み中にエラーが発生しました: {error}")
 
     def update_display(self):
         if self.image_pixmap:
-            scaled = self.image_pixmap.scaled(
-                self.size(), Qt.AspectRatioMode.KeepAspectRatio,
-                Qt.TransformationMode.SmoothTransformation)
+            cache_key = self._scaled_cache_key()
+            scaled = self.scaled_cache.get(cache_key)
+            if scaled is None and self.resizing:
+                # Cheap preview while dragging the corner; mouseReleaseEvent
+                # does the smooth rescale once the drag ends
+                scaled = self.image_pixmap.scaled(
+                    self.size(), Qt.AspectRatioMode.KeepAspectRatio,
+                    Qt.TransformationMode.FastTransformation)
+            elif scaled is None:
+                with profiler.stage("scale"):
+                    scaled = self.image_pixmap.scaled(
+                        self.size(), Qt.AspectRatioMode.KeepAspectRatio,
+                        Qt.TransformationMode.SmoothTransformation)
+                self.scaled_cache.put(cache_key, scaled, self._pixmap_bytes(scaled))
             self.label.setPixmap(scaled)
+            from image_cache import proxy_factor # Already loaded by the render that made image_pixmap
+            if self.image_factor > 1 and proxy_factor(
+                    (self.image_pixmap.width() * self.image_factor, self.image_pixmap.height() * self.image_factor),
+                    (self.width(), self.height())) < self.image_factor:
+                # The window outgrew the preview proxy; key a larger one
+                self.render_timer.start()
         self.label.setGeometry(self.rect())
 
+    def update_profile_label(self):
+        self.profile_label.setText(profiler.hud_text())
+        self.profile_label.adjustSize()
+        self.profile_label.raise_()
+
+    def _scaled_cache_key(self):
+        return (self.image_pixmap.cacheKey(), self.width(), self.height())
+
+    def _pixmap_bytes(self, pixmap):
+        return pixmap.width() * pixmap.height() * 4
+
     def resizeEvent(self, event):
         self.label.setGeometry(self.rect())
         self.slider_label.move(10, 10)
@@ -191,12 +412,28 @@ class TransparentImageViewer(QWidget):
         self.minimize_button.move(self.width() - 55, 5)
         self.close_button.move(self.width() - 30, 5)
 
-        self.update_display()
+        self.display_timer.start()
 
     def showEvent(self, event): # Added for re-display after minimize
         super().showEvent(event)
         self.update_display()
 
+    def closeEvent(self, event):
+        self.render_generation += 1
+        self.similar_generation += 1
+        if self.prefetcher:
+            self.prefetcher.cancel()
+        self.render_pool.clear()
+        self.render_pool.waitForDone()
+        if self.pipeline and self.pipeline.keyed_store:
+            self.pipeline.keyed_store.close()
+        if self.catalog_monitor:
+            self.catalog_monitor.stop()
+        self._close_bundle()
+        if self._db is not None:
+            self._db.close()
+        super().closeEvent(event)
+
     def mousePressEvent(self, event: QMouseEvent):
         if event.button() == Qt.MouseButton.LeftButton:
             # Check if clicked on minimize/close buttons, if so, don't drag/resize
@@ -228,7 +465,9 @@ class TransparentImageViewer(QWidget):
                 self.setCursor(Qt.CursorShape.ArrowCursor)
 
     def mouseReleaseEvent(self, event: QMouseEvent):
-        self.resizing = False
+        if self.resizing:
+            self.resizing = False
+            self.update_display() # Smooth rescale at the final size
 
     def _in_resize_corner(self, pos):
         return pos.x() >= self.width() - self.triangle_size and pos.y() >= self.height() - self.triangle_size
@@ -237,22 +476,32 @@ class TransparentImageViewer(QWidget):
         return pos.y() <= self.header_height
 
     def paintEvent(self, event):
-        painter = QPainter(self)
-        pen = QPen(Qt.GlobalColor.white)
-        pen.setWidth(2)
-        painter.setPen(pen)
-
-        painter.drawRect(self.rect().adjusted(1, 1, -2, -2))
-
-        points = [
-            QPoint(self.width(), self.height()),
-            QPoint(self.width() - self.triangle_size, self.height()),
-            QPoint(self.width(), self.height() - self.triangle_size)
-        ]
-        painter.setBrush(Qt.GlobalColor.white)
-        painter.drawPolygon(*points)
-
-        painter.drawRect(0, 0, self.width(), self.header_height)
+        with profiler.stage("paint"):
+            painter = QPainter(self)
+            pen = QPen(Qt.GlobalColor.white)
+            pen.setWidth(2)
+            painter.setPen(pen)
+
+            painter.drawRect(self.rect().adjusted(1, 1, -2, -2))
+
+            points = [
+                QPoint(self.width(), self.height()),
+                QPoint(self.width() - self.triangle_size, self.height()),
+                QPoint(self.width(), self.height() - self.triangle_size)
+            ]
+            painter.setBrush(Qt.GlobalColor.white)
+            painter.drawPolygon(*points)
+
+            painter.drawRect(0, 0, self.width(), self.header_height)
+
+        if not self.first_frame_done:
+            self.first_frame_done = True
+            self._report_startup("first frame")
+            # Open the database and load the imaging stack now that the window is up
+            QTimer.singleShot(0, self._warm_up)
+            if self.initial_open is not None:
+                QTimer.singleShot(0, lambda: self.open_initial(*self.initial_open))
+            self._startup_checkpoint()
 
     def contextMenuEvent(self, event):
         menu = QMenu(self)
@@ -260,15 +509,34 @@ class TransparentImageViewer(QWidget):
         save_image_action = menu.addAction("画像を保存する (データベースへ)")
         load_drug_images_action = menu.addAction("薬剤の画像を読み込む (データベースから)")
         delete_image_action = menu.addAction("現在の画像を削除する (データベースから)")
+        find_similar_action = menu.addAction("似ている画像を探す (データベースから)")
+        menu.addSeparator()
+        add_key_color_action = menu.addAction("透過色を追加する")
+        add_key_range_action = menu.addAction("透過する色の範囲を追加する")
+        clear_key_ranges_action = menu.addAction(f"追加した透過色を消す ({len(self.key_ranges)} 件)")
+        clear_key_ranges_action.setEnabled(bool(self.key_ranges))
+        border_only_action = menu.addAction("外周につながる背景だけを透過する")
+        border_only_action.setCheckable(True)
+        border_only_action.setChecked(self.border_only)
         action = menu.exec(event.globalPos())
         if action == change_color_action:
             self.select_color_and_reprocess()
+        elif action == add_key_color_action:
+            self.add_key_color()
+        elif action == add_key_range_action:
+            self.add_key_range()
+        elif action == clear_key_ranges_action:
+            self.set_key_ranges(())
         elif action == save_image_action:
             self.save_image_to_database_dialog()
         elif action == load_drug_images_action:
             self.load_from_database()
         elif action == delete_image_action:
             self.confirm_and_delete_current_image()
+        elif action == find_similar_action:
+            self.find_similar_images()
+        elif action == border_only_action:
+            self.set_border_only(border_only_action.isChecked())
 
     def select_color_and_reprocess(self):
         color = QColorDialog.getColor(initial=QColor(*self.target_rgb), parent=self)
@@ -289,154 +557,298 @@ class TransparentImageViewer(QWidget):
                 current_image_entry[4] = value
                 self.loaded_images_data[self.current_image_index] = tuple(current_image_entry)
 
-            self.process_and_show(self.current_image_path, self.target_rgb, self.tolerance)
+            self.render_timer.start()
+
+    def set_border_only(self, border_only):
+        self.border_only = border_only
+        if self.current_image_path:
+            # Like the tolerance, the mode of a DB image is kept in memory until it is saved again
+            if 0 <= self.current_image_index < len(self.loaded_images_data):
+                current_image_entry = list(self.loaded_images_data[self.current_image_index])
+                current_image_entry[5] = border_only
+                self.loaded_images_data[self.current_image_index] = tuple(current_image_entry)
+            self._request_render()
+
+    def add_key_color(self):
+        # The added colour is keyed within the current tolerance, but stays
+        # fixed when the slider moves afterwards
+        color = QColorDialog.getColor(initial=QColor(*self.target_rgb), parent=self, title="追加する透過色")
+        if color.isValid():
+            from keying import color_range
+            rgb = (color.red(), color.green(), color.blue())
+            self.set_key_ranges(self.key_ranges + (color_range(rgb, self.tolerance),))
+
+    def add_key_range(self):
+        # Every colour inside the box spanned by the two picks is keyed (shadows, gradients)
+        first = QColorDialog.getColor(initial=QColor(*self.target_rgb), parent=self, title="範囲の一方の端の色")
+        if not first.isValid():
+            return
+        second = QColorDialog.getColor(initial=first, parent=self, title="範囲のもう一方の端の色")
+        if second.isValid():
+            a = (first.red(), first.green(), first.blue())
+            b = (second.red(), second.green(), second.blue())
+            self.set_key_ranges(self.key_ranges + ((tuple(map(min, a, b)), tuple(map(max, a, b))),))
+
+    def set_key_ranges(self, key_ranges):
+        self.key_ranges = key_ranges
+        if self.current_image_path:
+            # Kept in memory for a DB image until it is saved again, like the tolerance
+            if 0 <= self.current_image_index < len(self.loaded_images_data):
+                current_image_entry = list(self.loaded_images_data[self.current_image_index])
+                current_image_entry[6] = key_ranges
+                self.loaded_images_data[self.current_image_index] = tuple(current_image_entry)
+            self._request_render()
 
 
     def save_image_to_database_dialog(self):
+        if self._reject_bundle_image():
+            return
         if not self.current_image_path:
             QMessageBox.warning(self, "エラー", "表示されている画像がありません。")
             return
 
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        cursor.execute("SELECT DISTINCT drug_name FROM images ORDER BY drug_name")
-        drug_names = [row[0] for row in cursor.fetchall()]
-        conn.close()
-
-        dialog = QDialog(self)
-        dialog.setWindowTitle("薬剤名の選択または新規入力")
-        layout = QVBoxLayout()
-
-        list_label = QLabel("既存の薬剤名:")
-        layout.addWidget(list_label)
-
-        drug_list_widget = QListWidget()
-        drug_list_widget.addItems(drug_names)
-        drug_list_widget.setSelectionMode(QListWidget.SelectionMode.SingleSelection)
-        layout.addWidget(drug_list_widget)
-
-        new_drug_label = QLabel("または新しい薬剤名を入力:")
-        layout.addWidget(new_drug_label)
-        new_drug_input = QLineEdit()
-        layout.addWidget(new_drug_input)
-
-        buttons_layout = QHBoxLayout()
-        ok_button = QPushButton("保存")
-        cancel_button = QPushButton("キャンセル")
-        buttons_layout.addWidget(ok_button)
-        buttons_layout.addWidget(cancel_button)
-        layout.addLayout(buttons_layout)
-        dialog.setLayout(layout)
-
-        selected_drug_name = ""
-
-        def on_ok_clicked():
-            nonlocal selected_drug_name
-            if new_drug_input.text().strip():
-                selected_drug_name = new_drug_input.text().strip()
-            elif drug_list_widget.currentItem():
-                selected_drug_name = drug_list_widget.currentItem().text()
-            dialog.accept()
-
-        ok_button.clicked.connect(on_ok_clicked)
-        cancel_button.clicked.connect(dialog.reject)
-
-        # Corrected line: Use QDialog.DialogCode.Accepted
-        if dialog.exec() == QDialog.DialogCode.Accepted and selected_drug_name:
-            self._save_image_to_db(selected_drug_name)
-        elif dialog.exec() == QDialog.DialogCode.Accepted and not selected_drug_name:
-            QMessageBox.warning(self, "入力エラー", "薬剤名が選択または入力されていません。")
-
+        dialog = DrugPickerDialog(self.db, "薬剤名の選択または新規入力", allow_new=True, parent=self)
+        if dialog.exec() == QDialog.DialogCode.Accepted:
+            selected_drug_name = dialog.selected_name()
+            if selected_drug_name:
+                self._save_image_to_db(selected_drug_name)
+            else:
+                QMessageBox.warning(self, "入力エラー", "薬剤名が選択または入力されていません。")
+
+
+    def _start_phash_job(self, request):
+        # Hash the image as currently keyed on a worker; decoding a large
+        # scan here would freeze the window. Ends in _on_phash_finished
+        from render_pipeline import PhashJob
+        self._ensure_pipeline()
+        self.render_pool.start(PhashJob(
+            self.phash_signals, request, self.current_image_path, self.target_rgb, self.tolerance, self.border_only,
+            self.key_ranges))
+
+    def _on_phash_finished(self, request, phash):
+        if request[0] == "save":
+            # The row was saved without a hash; an unreadable image keeps NULL
+            # for find_similar.py update to retry
+            if phash is not None:
+                from phash import to_db
+                try:
+                    self.db.set_phashes([(to_db(phash), request[1])])
+                except sqlite3.Error:
+                    return
+                self._phash_index = None
+            return
+        _, generation, path, exclude = request
+        QApplication.restoreOverrideCursor()
+        if generation != self.similar_generation:
+            return # Superseded by a newer search, or the window is closing
+        if phash is None:
+            QMessageBox.critical(self, "エラー", f"画像を読み込めませんでした: {path}")
+            return
+        self._show_similar_images(phash, exclude)
 
     def _save_image_to_db(self, drug_name):
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
         try:
-            cursor.execute('''
-                INSERT INTO images (drug_name, image_path, target_rgb_r, target_rgb_g, target_rgb_b, tolerance)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (
-                drug_name, self.current_image_path,
-                self.target_rgb[0], self.target_rgb[1], self.target_rgb[2],
-                self.tolerance
-            ))
-            conn.commit()
+            image_id = self.db.add_image(drug_name, self.current_image_path, self.target_rgb, self.tolerance,
+                                         self.border_only, None, self.key_ranges)
+            self._phash_index = None
+            self._start_phash_job(("save", image_id))
+            if self.catalog_monitor:
+                self.catalog_monitor.add_path(self.current_image_path)
+            from render_pipeline import StoreJob
+            # Store at the size the drug will be browsed at; with proxies on
+            # that is a display-sized entry, not a full-size PNG
+            self.render_pool.start(StoreJob(
+                self._ensure_pipeline(), self.current_image_path, self.target_rgb, self.tolerance, self.border_only,
+                self.key_ranges, (self.width(), self.height()) if config.PREVIEW_PROXY else None))
             QMessageBox.information(self, "保存完了", f"'{drug_name}' の画像を保存しました。")
         except sqlite3.Error as e:
             QMessageBox.critical(self, "データベースエラー", f"画像の保存中にエラーが発生しました: {e}")
-        finally:
-            conn.close()
 
     def load_from_database(self):
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        cursor.execute("SELECT DISTINCT drug_name FROM images ORDER BY drug_name")
-        drug_names = [row[0] for row in cursor.fetchall()]
-        conn.close()
-
-        if not drug_names:
+        # The picker only reads the first page of names; more are fetched as the list scrolls
+        dialog = DrugPickerDialog(self.db, "薬剤を選択", parent=self)
+        if dialog.is_empty():
             QMessageBox.information(self, "情報", "データベースに薬剤が登録されていません。")
             return
 
-        drug_name, ok = QInputDialog.getItem(
-            self, "薬剤を選択", "読み込む薬剤を選択してください:", drug_names, 0, False)
-
-        if ok and drug_name:
-            conn = sqlite3.connect(self.db_name)
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id, drug_name, image_path, target_rgb_r, target_rgb_g, target_rgb_b, tolerance
-                FROM images WHERE drug_name = ?
-                ORDER BY id
-            ''', (drug_name,))
-            self.loaded_images_data = []
-            for row in cursor.fetchall():
-                # Store (id, drug_name, image_path, (r,g,b), tolerance)
-                self.loaded_images_data.append((row[0], row[1], row[2], (row[3], row[4], row[5]), row[6]))
-            conn.close()
+        if dialog.exec() == QDialog.DialogCode.Accepted:
+            drug_name = dialog.selected_name()
+            if drug_name:
+                self.load_drug(drug_name)
+            else:
+                QMessageBox.warning(self, "選択エラー", "薬剤が選択されていません。")
 
-            if self.loaded_images_data:
-                self.current_image_index = 0
-                self.display_current_loaded_image()
+    def find_similar_images(self):
+        if self._reject_bundle_image():
+            return
+        if not self.current_image_path:
+            QMessageBox.warning(self, "エラー", "表示されている画像がありません。")
+            return
+
+        exclude = ()
+        if 0 <= self.current_image_index < len(self.loaded_images_data):
+            exclude = (self.loaded_images_data[self.current_image_index][0],)
+        self.similar_generation += 1
+        # Restored in _on_phash_finished once the hash is ready
+        QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
+        self._start_phash_job(("search", self.similar_generation, self.current_image_path, exclude))
+
+    def _show_similar_images(self, phash, exclude):
+        from phash import PhashIndex
+        from similar_dialog import SimilarImagesDialog
+        QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
+        try:
+            if self._phash_index is None:
+                self._phash_index = PhashIndex.from_db(self.db)
+            missing = self.db.count_images_without_phash()
+        finally:
+            QApplication.restoreOverrideCursor()
+
+        results = []
+        for image_id, distance in self._phash_index.nearest(phash, k=20, exclude_ids=exclude):
+            row = self.db.image_by_id(image_id)
+            if row:
+                results.append((*row, distance))
+        note = f"知覚ハッシュが未計算の画像が {missing} 件あります (python find_similar.py update で計算できます)。" if missing else ""
+        dialog = SimilarImagesDialog(results, note, parent=self)
+        if dialog.exec() == QDialog.DialogCode.Accepted and dialog.selected():
+            image_id, drug_name = dialog.selected()
+            self.load_drug(drug_name, image_id)
+
+    def open_bundle(self, path):
+        # All images are read from one mmap, so < / > never open another file
+        from bundle import DrugBundle
+        try:
+            bundle = DrugBundle(path)
+        except (OSError, ValueError) as e:
+            if self.measure_startup:
+                print(f"startup: failed to open {path}: {e}", file=sys.stderr, flush=True)
+                self.startup_wait_for_image = False
+                self._startup_checkpoint()
             else:
-                QMessageBox.information(self, "情報", f"'{drug_name}' に関連する画像が見つかりませんでした。")
-        elif ok:
-             QMessageBox.warning(self, "選択エラー", "薬剤が選択されていません。")
+                QMessageBox.critical(self, "エラー", f"バンドルを開けませんでした: {e}")
+            return
+        self._close_bundle()
+        self.bundle = bundle
+        # Bundle images are keyed already; there is nothing to re-key with the slider
+        self.tolerance_slider.setEnabled(False)
+        if self.catalog_monitor:
+            self.catalog_monitor.watch_files([])
+        if self.prefetcher:
+            self.prefetcher.cancel()
+        self.loaded_images_data = list(bundle.entries)
+        self.current_image_index = 0 if self.loaded_images_data else -1
+        self.display_current_loaded_image()
+
+    def _close_bundle(self):
+        if self.bundle is not None:
+            self.bundle.close()
+            self.bundle = None
+            self.tolerance_slider.setEnabled(True)
+
+    def _show_bundle_image(self):
+        _id, _drug_name, _image_path, target_rgb, tolerance, border_only, key_ranges = \
+            self.loaded_images_data[self.current_image_index]
+        self.render_generation += 1 # Drop any render still in flight
+        self.render_timer.stop()
+        self.current_image_path = None # No source file to re-key
+        self.target_rgb, self.tolerance, self.border_only, self.key_ranges = target_rgb, tolerance, border_only, key_ranges
+        self.tolerance_slider.blockSignals(True)
+        self.tolerance_slider.setValue(tolerance)
+        self.tolerance_slider.blockSignals(False)
+        self.slider_label.setText(f"透過範囲: {tolerance}")
+        try:
+            argb = self.bundle.argb32(self.current_image_index)
+        except ValueError as e:
+            self.update_image_counter()
+            QMessageBox.critical(self, "エラー", f"バンドルの画像を読み込めませんでした: {e}")
+            return
+        height, width = argb.shape[:2]
+        # Like a render result: the pixmap shares the (mmap-backed) array, so keep it alive
+        self.image_buffer = argb
+        qimg = QImage(argb.data, width, height, width * 4, QImage.Format.Format_ARGB32_Premultiplied)
+        with profiler.stage("from_image"):
+            self.image_pixmap = QPixmap.fromImage(qimg)
+        self.image_factor = 1
+        self.update_display()
+        self.update_image_counter()
+        if not self.first_image_done:
+            self.first_image_done = True
+            self._report_startup("first image")
+            self._startup_checkpoint()
+
+    def _reject_bundle_image(self):
+        # Bundle entries have no database row; they have to be imported first
+        if self.bundle is None:
+            return False
+        QMessageBox.information(self, "情報",
+                                "バンドルの画像は drug_bundle.py import でデータベースに取り込んでから操作してください。")
+        return True
+
+    def load_drug(self, drug_name, image_id=None):
+        self._close_bundle()
+        self.loaded_images_data = self.db.images_for_drug(drug_name)
+        if self.catalog_monitor:
+            self.catalog_monitor.watch_files(entry[2] for entry in self.loaded_images_data)
+
+        if self.loaded_images_data:
+            self.current_image_index = next(
+                (i for i, entry in enumerate(self.loaded_images_data) if entry[0] == image_id), 0)
+            self.display_current_loaded_image()
+        elif self.measure_startup:
+            print(f"startup: no images for drug {drug_name!r}", file=sys.stderr, flush=True)
+        else:
+            QMessageBox.information(self, "情報", f"'{drug_name}' に関連する画像が見つかりませんでした。")
 
     def display_current_loaded_image(self):
-        if 0 <= self.current_image_index < len(self.loaded_images_data):
+        if self.bundle is not None and 0 <= self.current_image_index < len(self.loaded_images_data):
+            self._show_bundle_image()
+        elif 0 <= self.current_image_index < len(self.loaded_images_data):
             image_data = self.loaded_images_data[self.current_image_index]
-            _id, drug_name, image_path, target_rgb, tolerance = image_data
-            if os.path.exists(image_path):
-                self.process_and_show(image_path, target_rgb, tolerance)
-                self.update_image_counter()
-            else:
-                reply = QMessageBox.question(self, "ファイルが見つかりません",
-                                    f"画像ファイル '{image_path}' が見つかりません。\nこの画像をデータベースから削除しますか？",
-                                    QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
-                if reply == QMessageBox.StandardButton.Yes:
-                    self.delete_image_from_db(_id, prompt_user=False) # Delete without re-prompting
-                    # Remove from in-memory list
-                    self.loaded_images_data.pop(self.current_image_index)
-                    # Try to display next image or re-load drug
-                    if self.loaded_images_data:
-                        self.current_image_index = min(self.current_image_index, len(self.loaded_images_data) - 1)
-                        self.display_current_loaded_image()
-                    else:
-                        self.image_pixmap = None
-                        self.label.clear()
-                        self.current_image_path = None
-                        self.update_image_counter()
-                else:
-                    # If user chooses not to delete, we need to handle this state.
-                    # For simplicity, we can clear the display or stay on the broken entry.
-                    # Clearing is safer to prevent endless loop on missing files.
-                    self.image_pixmap = None
-                    self.label.clear()
-                    self.current_image_path = None
-                    self.update_image_counter() # Update to 0/0 when no images
+            _id, drug_name, image_path, target_rgb, tolerance, border_only, key_ranges = image_data
+            # Missing files are known from the background scan; a file that
+            # vanished since then fails in the render job (_on_render_failed)
+            if self.catalog_monitor and self.catalog_monitor.is_missing(image_path):
+                self._prompt_missing_loaded_image()
+                return
+            self.process_and_show(image_path, target_rgb, tolerance, use_store=True, border_only=border_only,
+                                  key_ranges=key_ranges)
+            self.update_image_counter()
+            # Decode and key the neighbours so < / > can show them straight away
+            preview_size = (self.width(), self.height()) if config.PREVIEW_PROXY else None
+            self._ensure_pipeline()
+            self.prefetcher.update(self.loaded_images_data, self.current_image_index, preview_size)
+        else:
+            self.render_generation += 1 # Drop any render still in flight
+            self.image_pixmap = None
+            self.label.clear()
+            self.current_image_path = None
+            self.update_image_counter() # Update to 0/0 when no images
 
+    def _prompt_missing_loaded_image(self):
+        _id, _drug_name, image_path, _, _, _, _ = self.loaded_images_data[self.current_image_index]
+        reply = QMessageBox.question(self, "ファイルが見つかりません",
+                            f"画像ファイル '{image_path}' が見つかりません。\nこの画像をデータベースから削除しますか？",
+                            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
+        if reply == QMessageBox.StandardButton.Yes:
+            self.delete_image_from_db(_id, prompt_user=False) # Delete without re-prompting
+            # Remove from in-memory list
+            self.loaded_images_data.pop(self.current_image_index)
+            # Try to display next image or re-load drug
+            if self.loaded_images_data:
+                self.current_image_index = min(self.current_image_index, len(self.loaded_images_data) - 1)
+                self.display_current_loaded_image()
+            else:
+                self.render_generation += 1 # Drop any render still in flight
+                self.image_pixmap = None
+                self.label.clear()
+                self.current_image_path = None
+                self.update_image_counter()
         else:
+            # If user chooses not to delete, we need to handle this state.
+            # For simplicity, we can clear the display or stay on the broken entry.
+            # Clearing is safer to prevent endless loop on missing files.
+            self.render_generation += 1 # Drop any render still in flight
             self.image_pixmap = None
             self.label.clear()
             self.current_image_path = None
@@ -458,12 +870,14 @@ class TransparentImageViewer(QWidget):
         self.image_counter_label.setText(f"{current}/{total}")
 
     def confirm_and_delete_current_image(self):
+        if self._reject_bundle_image():
+            return
         if not self.loaded_images_data or self.current_image_index == -1:
             QMessageBox.information(self, "情報", "削除する画像が選択されていません。")
             return
 
         current_image_entry = self.loaded_images_data[self.current_image_index]
-        image_id, drug_name, image_path, _, _ = current_image_entry
+        image_id, drug_name, image_path, _, _, _, _ = current_image_entry
 
         reply = QMessageBox.question(self, "削除確認",
                                      f"現在の画像 (薬剤名: '{drug_name}', パス: '{os.path.basename(image_path)}') をデータベースから削除しますか？\nこの操作は元に戻せません。",
@@ -477,27 +891,43 @@ class TransparentImageViewer(QWidget):
                 self.current_image_index = min(self.current_image_index, len(self.loaded_images_data) - 1)
                 self.display_current_loaded_image()
             else:
+                self.render_generation += 1 # Drop any render still in flight
                 self.image_pixmap = None
                 self.label.clear()
                 self.current_image_path = None
                 self.update_image_counter()
 
     def delete_image_from_db(self, image_id, prompt_user=True):
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
         try:
-            cursor.execute("DELETE FROM images WHERE id = ?", (image_id,))
-            conn.commit()
+            self.db.delete_image(image_id)
+            self._phash_index = None
             if prompt_user:
                 QMessageBox.information(self, "削除完了", "画像をデータベースから削除しました。")
         except sqlite3.Error as e:
             QMessageBox.critical(self, "データベースエラー", f"画像の削除中にエラーが発生しました: {e}")
-        finally:
-            conn.close()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="背景色を透過して画像を表示する")
+    parser.add_argument("image", nargs="?", help="起動時に開く画像ファイルまたはバンドル (.drugbundle)")
+    parser.add_argument("--drug", help="起動時にデータベースから読み込む薬剤名")
+    parser.add_argument("--db", default="drugs.db", help="データベースファイル (既定: drugs.db)")
+    parser.add_argument("--profile", action="store_true", help="処理段階ごとの時間を計測する")
+    parser.add_argument("--startup-time", action="store_true", default=bool(config.STARTUP_TIME),
+                        help="起動時間 (最初の描画・最初の画像) を表示して終了する")
+    # Anything argparse doesn't know is left for Qt (-style, -platform, ...)
+    return parser.parse_known_args(argv)
 
 
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
-    viewer = TransparentImageViewer()
+    args, qt_args = parse_args(sys.argv[1:])
+    if args.profile:
+        profiler.enable()
+    app = QApplication(sys.argv[:1] + qt_args)
+    viewer = TransparentImageViewer(args.db, measure_startup=args.startup_time)
+    viewer.startup_wait_for_image = bool(args.image or args.drug)
+    # Opened from the first paint, so the window shows before numpy/Pillow
+    # and the database are loaded
+    viewer.initial_open = (args.image, args.drug)
     viewer.show()
     sys.exit(app.exec())
@@ -0,0 +1,41 @@
+import os
+
+from PyQt6.QtCore import Qt
+from PyQt6.QtWidgets import QDialog, QHBoxLayout, QLabel, QListWidget, QListWidgetItem, QPushButton, QVBoxLayout
+
+
+class SimilarImagesDialog(QDialog):
+    """似ている登録画像の一覧。選んだ画像の (画像 ID, 薬剤名) を selected() で返す
+
+    results は (画像 ID, 薬剤名, 画像パス, 距離) のリスト。
+    """
+
+    def __init__(self, results, note="", parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("似ている画像")
+        self.list_widget = QListWidget()
+        for image_id, drug_name, image_path, distance in results:
+            item = QListWidgetItem(f"距離 {distance:>2}  {drug_name} — {os.path.basename(image_path)}")
+            item.setToolTip(image_path)
+            item.setData(Qt.ItemDataRole.UserRole, (image_id, drug_name))
+            self.list_widget.addItem(item)
+        if results:
+            self.list_widget.setCurrentRow(0)
+        self.list_widget.itemDoubleClicked.connect(self.accept)
+
+        layout = QVBoxLayout()
+        layout.addWidget(QLabel("距離 (0〜64) が小さいほど似ています。" + (f"\n{note}" if note else "")))
+        layout.addWidget(self.list_widget)
+        buttons_layout = QHBoxLayout()
+        open_button = QPushButton("開く")
+        close_button = QPushButton("閉じる")
+        open_button.clicked.connect(self.accept)
+        close_button.clicked.connect(self.reject)
+        buttons_layout.addWidget(open_button)
+        buttons_layout.addWidget(close_button)
+        layout.addLayout(buttons_layout)
+        self.setLayout(layout)
+
+    def selected(self):
+        item = self.list_widget.currentItem()
+        return item.data(Qt.ItemDataRole.UserRole) if item else None
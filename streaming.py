@@ -0,0 +1,133 @@
+"""巨大な画像を帯 (行のまとまり) ごとに透過処理・書き出しする
+
+画像全体の RGBA 配列や距離マップは作らず、一度に持つのは元画像 (読み込んだ
+モードのまま) と 1 帯分の配列だけにする。出力 PNG も帯ごとに圧縮して書き込む。
+"""
+import struct
+import zlib
+
+import numpy as np
+
+from keying import border_connected_runs, corner_color, distance_map, key_color, mask_runs, runs_to_mask
+
+STRIP_ROWS = 256
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+class PngStreamWriter:
+    """RGBA 8bit の PNG を行単位で書き出す"""
+
+    def __init__(self, path, width, height, compress_level=6):
+        self.width = width
+        self._file = open(path, "wb")
+        self._compressor = zlib.compressobj(compress_level)
+        self._file.write(PNG_SIGNATURE)
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+
+    def write_rows(self, rgba):
+        """rgba: (行数, width, 4) の uint8 配列"""
+        rows = np.ascontiguousarray(rgba).reshape(rgba.shape[0], self.width * 4)
+        # 各行に Sub フィルタ (左隣の画素との差分) をかけると写真でもよく縮む
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = 1
+        filtered[:, 1:5] = rows[:, :4]
+        np.subtract(rows[:, 4:], rows[:, :-4], out=filtered[:, 5:])
+        data = self._compressor.compress(filtered.tobytes())
+        if data:
+            self._chunk(b"IDAT", data)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._chunk(b"IDAT", self._compressor.flush())
+        self._chunk(b"IEND", b"")
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _chunk(self, chunk_type, data):
+        self._file.write(struct.pack(">I", len(data)))
+        self._file.write(chunk_type)
+        self._file.write(data)
+        self._file.write(struct.pack(">I", zlib.crc32(chunk_type + data)))
+
+
+def iter_rgba_strips(img, box=None, strip_rows=STRIP_ROWS):
+    """読み込み済みの PIL 画像を box の範囲で帯ごとに RGBA 配列にして (上端の y, 配列) を返す"""
+    left, top, right, bottom = box or (0, 0, img.width, img.height)
+    for y in range(top, bottom, strip_rows):
+        strip = img.crop((left, y, right, min(y + strip_rows, bottom)))
+        yield y, np.array(strip.convert("RGBA"))
+
+
+def corner_color_of(img):
+    """四隅の平均色（画像全体を RGBA 化せずに求める）"""
+    width, height = img.size
+    corners = [
+        np.array(img.crop((x, y, x + 1, y + 1)).convert("RGBA"))[0, 0]
+        for x, y in ((0, 0), (width - 1, 0), (0, height - 1), (width - 1, height - 1))
+    ]
+    return corner_color(np.array(corners).reshape(2, 2, 4))
+
+
+def border_background(img, target_rgb, tolerance, strip_rows=STRIP_ROWS, key_ranges=()):
+    """画像の外周につながる背景を run (行, 開始列, 終了列) の配列で返す
+
+    帯ごとに背景色の画素を run にまとめ、全体の run をつないで外周から届くものだけを残す。
+    run は画素よりずっと少ないので、画像全体の 2 値画像を持たずに済む。
+    """
+    runs = [
+        mask_runs(distance_map(rgba, target_rgb, key_ranges) <= tolerance, y)
+        for y, rgba in iter_rgba_strips(img, strip_rows=strip_rows)
+    ]
+    rows, starts, ends = (np.concatenate(parts) for parts in zip(*runs))
+    connected = border_connected_runs(rows, starts, ends, img.height, img.width)
+    return rows[connected], starts[connected], ends[connected]
+
+
+def _key_strip(rgba, y, left, width, target_rgb, tolerance, background, key_ranges=()):
+    # background (border_background の結果) があればその範囲だけを透過する
+    if background is None:
+        return key_color(rgba, target_rgb, tolerance, key_ranges=key_ranges)
+    rows, starts, ends = background
+    lo, hi = np.searchsorted(rows, [y, y + rgba.shape[0]])
+    clear = runs_to_mask(rows[lo:hi], starts[lo:hi], ends[lo:hi], rgba.shape[0], width, y)
+    rgba[..., 3][clear[:, left:left + rgba.shape[1]].view(bool)] = 0
+    return rgba
+
+
+def keyed_bbox(img, target_rgb, tolerance, strip_rows=STRIP_ROWS, background=None, key_ranges=()):
+    """透過処理後に α が 0 でない範囲 (left, top, right, bottom) を返す。全て透過なら None"""
+    left = top = right = bottom = None
+    for y, rgba in iter_rgba_strips(img, strip_rows=strip_rows):
+        alpha = _key_strip(rgba, y, 0, img.width, target_rgb, tolerance, background, key_ranges)[..., 3]
+        rows = np.flatnonzero(alpha.any(axis=1))
+        if not rows.size:
+            continue
+        cols = np.flatnonzero(alpha.any(axis=0))
+        if top is None:
+            top = y + rows[0]
+            left, right = cols[0], cols[-1] + 1
+        left = min(left, cols[0])
+        right = max(right, cols[-1] + 1)
+        bottom = y + rows[-1] + 1
+    if top is None:
+        return None
+    return int(left), int(top), int(right), int(bottom)
+
+
+def write_keyed_png(img, path, target_rgb, tolerance, box=None, strip_rows=STRIP_ROWS, compress_level=6,
+                    background=None, key_ranges=()):
+    """box の範囲を帯ごとに透過処理して PNG に書き出す
+
+    background に border_background の結果を渡すと、外周につながる背景だけを透過する。
+    key_ranges は keying.distance_map と同じ (背景として扱う色の範囲)。
+    """
+    left, top, right, bottom = box or (0, 0, img.width, img.height)
+    with PngStreamWriter(path, right - left, bottom - top, compress_level) as writer:
+        for y, rgba in iter_rgba_strips(img, box, strip_rows):
+            writer.write_rows(_key_strip(rgba, y, left, img.width, target_rgb, tolerance, background, key_ranges))
@@ -1,45 +1,64 @@
-from PyQt6.QtWidgets import QApplication, QWidget, QLabel, QPushButton, QVBoxLayout, QFileDialog
-from PyQt6.QtGui import QPixmap
-from PyQt6.QtCore import Qt
+from PyQt6.QtWidgets import (QApplication, QWidget, QLabel, QPushButton, QVBoxLayout, QHBoxLayout, QFileDialog,
+                             QCheckBox, QComboBox, QSpinBox)
+from PyQt6.QtGui import QImage, QPixmap
+from PyQt6.QtCore import QObject, QRunnable, QThreadPool, Qt, pyqtSignal
+from corner_crop import (OutputOptions, auto_transparent_by_corner, crop_by_corner, output_path_for, save_output,
+                         use_streaming)
 from PIL import Image
+import config
 import sys
 import os
 
-def auto_transparent_by_corner(image_path, tolerance=30):
-    """四隅の背景色を透過し、非透過部分だけをクロップして保存"""
-    img = Image.open(image_path).convert("RGBA")
-    width, height = img.size
-    pixels = img.load()
-
-    # 四隅の平均色を背景色と仮定
-    corners = [
-        pixels[0, 0],
-        pixels[width - 1, 0],
-        pixels[0, height - 1],
-        pixels[width - 1, height - 1]
-    ]
-    avg_color = tuple(sum(c[i] for c in corners) // 4 for i in range(3))
-    print(f"推定背景色: {avg_color}")
-
-    new_data = []
-    for r, g, b, a in img.getdata():
-        if all(abs(val - avg) <= tolerance for val, avg in zip((r, g, b), avg_color)):
-            new_data.append((r, g, b, 0))  # 完全透過
-        else:
-            new_data.append((r, g, b, a))
-
-    img.putdata(new_data)
-
-    alpha = img.getchannel("A")
-    bbox = alpha.getbbox()
-    if bbox:
-        img = img.crop(bbox)
-
-    base, ext = os.path.splitext(image_path)
-    output_path = base + "_transparent_cropped.png"
-    img.save(output_path)
-    print(f"保存完了: {output_path}")
-    return output_path
+PREVIEW_WIDTH = 300
+# 帯ごとに処理する巨大な画像のプレビューは、この大きさまで縮小した画像から作る
+PREVIEW_DECODE_SIZE = (1024, 1024)
+
+
+def preview_qimage(img):
+    """クロップ済みの RGBA 画像を PREVIEW_WIDTH 幅の QImage にする（ワーカースレッドで呼ぶ）"""
+    if img.width > PREVIEW_WIDTH:
+        img = img.resize((PREVIEW_WIDTH, max(1, round(img.height * PREVIEW_WIDTH / img.width))),
+                         Image.Resampling.BILINEAR)
+    data = img.tobytes()
+    # QImage は data を参照するだけなので、copy() で Qt 側に持たせる
+    return QImage(data, img.width, img.height, img.width * 4, QImage.Format.Format_RGBA8888).copy()
+
+
+class CropSignals(QObject):
+    preview = pyqtSignal(int, object)  # generation, QImage
+    saved = pyqtSignal(int, str)  # generation, output path
+    failed = pyqtSignal(int, str)  # generation, error message
+
+
+class CropJob(QRunnable):
+    """透過・クロップ → プレビュー送信 → 保存をバックグラウンドで行う"""
+
+    def __init__(self, signals, generation, path, border_only, options):
+        super().__init__()
+        self.signals = signals
+        self.generation = generation
+        self.path = path
+        self.border_only = border_only
+        self.options = options
+
+    def run(self):
+        try:
+            if use_streaming(self.path, self.options):
+                # 原寸の配列を作らないよう、プレビューは縮小画像から作って保存は帯ごとに行う
+                img, _ = crop_by_corner(self.path, border_only=self.border_only, max_size=PREVIEW_DECODE_SIZE)
+                self.signals.preview.emit(self.generation, preview_qimage(img))
+                output_path = auto_transparent_by_corner(
+                    self.path, verbose=False, streaming=True, border_only=self.border_only, options=self.options)
+            else:
+                img, _ = crop_by_corner(self.path, border_only=self.border_only)
+                self.signals.preview.emit(self.generation, preview_qimage(img))
+                output_path = save_output(img, output_path_for(self.path, image_format=self.options.format),
+                                          self.options)
+        except Exception as e:
+            self.signals.failed.emit(self.generation, str(e))
+            return
+        self.signals.saved.emit(self.generation, output_path)
+
 
 class TransparentCropper(QWidget):
     def __init__(self):
@@ -49,21 +68,87 @@ class TransparentCropper(QWidget):
 
         self.label = QLabel("画像を選択してください")
         self.label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.status_label = QLabel("")
+        self.status_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
 
         self.select_button = QPushButton("画像を選択")
         self.select_button.clicked.connect(self.select_image)
 
+        # Only clear background reachable from the image border (keeps white imprints)
+        self.border_only_checkbox = QCheckBox("外周につながる背景だけを透過する")
+        self.border_only_checkbox.setChecked(bool(config.BORDER_ONLY))
+
+        self.format_combo = QComboBox()
+        self.format_combo.addItem("PNG", "png")
+        self.format_combo.addItem("WebP (可逆)", "webp")
+        self.format_combo.setCurrentIndex(max(0, self.format_combo.findData(config.OUTPUT_FORMAT)))
+        self.format_combo.currentIndexChanged.connect(self._update_format_widgets)
+        self.compress_spinbox = QSpinBox()
+        self.compress_spinbox.setRange(0, 9)
+        self.compress_spinbox.setValue(config.OUTPUT_COMPRESS_LEVEL)
+        self.compress_spinbox.setPrefix("圧縮レベル: ")
+        self.optimize_checkbox = QCheckBox("時間をかけて小さくする")
+        self.optimize_checkbox.setChecked(bool(config.OUTPUT_OPTIMIZE))
+        self._update_format_widgets()
+
+        format_layout = QHBoxLayout()
+        format_layout.addWidget(self.format_combo)
+        format_layout.addWidget(self.compress_spinbox)
+        format_layout.addWidget(self.optimize_checkbox)
+
         layout = QVBoxLayout()
         layout.addWidget(self.label)
+        layout.addWidget(self.status_label)
+        layout.addWidget(self.border_only_checkbox)
+        layout.addLayout(format_layout)
         layout.addWidget(self.select_button)
         self.setLayout(layout)
 
+        # 保存は 1 枚ずつ順に行い、表示は最後に選んだ画像のものだけにする
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self.generation = 0
+        self.signals = CropSignals(self)
+        self.signals.preview.connect(self._on_preview)
+        self.signals.saved.connect(self._on_saved)
+        self.signals.failed.connect(self._on_failed)
+
+    def output_options(self):
+        return OutputOptions(self.format_combo.currentData(), self.compress_spinbox.value(),
+                             self.optimize_checkbox.isChecked())
+
     def select_image(self):
         file_path, _ = QFileDialog.getOpenFileName(self, "画像ファイルを選択", "", "Images (*.png *.jpg *.jpeg *.bmp)")
         if file_path:
-            output_path = auto_transparent_by_corner(file_path)
-            self.label.setText(f"保存完了: {os.path.basename(output_path)}")
-            self.label.setPixmap(QPixmap(output_path).scaledToWidth(300, Qt.TransformationMode.SmoothTransformation))
+            self.start_crop(file_path)
+
+    def start_crop(self, file_path):
+        self.generation += 1
+        self.status_label.setText(f"処理中: {os.path.basename(file_path)}")
+        self.pool.start(CropJob(self.signals, self.generation, file_path, self.border_only_checkbox.isChecked(),
+                                self.output_options()))
+
+    def _update_format_widgets(self):
+        self.compress_spinbox.setEnabled(self.format_combo.currentData() == "png")
+
+    def _on_preview(self, generation, qimg):
+        if generation == self.generation:
+            self.label.setPixmap(QPixmap.fromImage(qimg))
+            self.status_label.setText("保存中...")
+
+    def _on_saved(self, generation, output_path):
+        if generation == self.generation:
+            self.status_label.setText(f"保存完了: {os.path.basename(output_path)}")
+
+    def _on_failed(self, generation, message):
+        if generation == self.generation:
+            self.label.setText("画像を選択してください")
+            self.status_label.setText(f"エラー: {message}")
+
+    def closeEvent(self, event):
+        # 書きかけの保存を終えてから閉じる
+        self.pool.waitForDone()
+        super().closeEvent(event)
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)